@@ -3,6 +3,7 @@
 # This code is distributed under the terms of the GNU General Public License, version 3 (GPLv3).
 # See the LICENSE file for details on the license terms.
 from .agent_based_api.v1 import (
+    get_value_store,
     render,
     check_levels,
     register,
@@ -12,26 +13,344 @@ from .agent_based_api.v1 import (
 )
 import zlib
 import json
+import math
+import os
+import tempfile
+import time
 import base64
-from typing import List, Any, Dict
-from datetime import datetime, timezone
-from collections import Counter
+import hashlib
+import threading
+from array import array
+from typing import List, Any, Callable, Dict, Iterable, NamedTuple, Optional, Tuple
+from datetime import datetime, timedelta, timezone
+from collections import Counter, OrderedDict
 
 
-def _join_section(section: List[List[str]]) -> str:
-    return '\n'.join([' '.join(line) for line in section])
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+GAP_SAMPLES = 64
+PARSE_CACHE_SIZE = 8
+KEYFRAME_CACHE_SIZE = 4
+KEYFRAME_DIR = os.path.join(os.environ['OMD_ROOT'], 'tmp', 'check_mk', 'mssql_log_shipping_keyframes') if os.environ.get('OMD_ROOT') else os.path.join(tempfile.gettempdir(), 'mssql_log_shipping_keyframes')
 
 
-def _decode_data(compressed_base64: str) -> str:
-    compressed_data = base64.b64decode(compressed_base64)
-    decompressed_base64 = zlib.decompress(compressed_data)
-    return decompressed_base64.decode('utf-8')
+def _decode_columns(data: Dict, strings: List[str]) -> List[Dict]:
+    columns = [
+        [strings[value] if value is not None else None for value in values] if kind == 's' else values
+        for kind, values in zip(data['k'], data['v'])
+    ]
+    return [dict(zip(data['#'], row)) for row in zip(*columns)]
 
 
-def parse_mssql_log_shipping(string_table: List[List[str]]) -> Dict:
-    base64_data = _join_section(string_table)
-    json_str = _decode_data(base64_data)
-    return json.loads(json_str)
+def _decode_columnar(data: Any, strings: List[str]) -> Any:
+    if isinstance(data, dict):
+        if '#' in data:
+            return _decode_columns(data, strings)
+        return {key: _decode_columnar(value, strings) for key, value in data.items()}
+    if isinstance(data, list):
+        return [_decode_columnar(value, strings) for value in data]
+    return data
+
+
+def _parse_timestamp(value: Any) -> datetime:
+    if isinstance(value, int):
+        return EPOCH + timedelta(microseconds=value)
+    return datetime.fromisoformat(value).replace(tzinfo=timezone.utc)
+
+
+def _decode_lines(section: Iterable[List[str]]) -> str:
+    decompressor = zlib.decompressobj()
+    chunks = []
+    pending = ''
+    for line in section:
+        for word in line:
+            pending += word
+            end = len(pending) - len(pending) % 4
+            chunks.append(decompressor.decompress(base64.b64decode(pending[:end])))
+            pending = pending[end:]
+    chunks.append(decompressor.decompress(base64.b64decode(pending)))
+    chunks.append(decompressor.flush())
+    return b''.join(chunks).decode('utf-8')
+
+
+class ParseCache:
+    """Least recently used parsed sections keyed by a hash of their raw lines, with hit and miss counters"""
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, string_table: List[List[str]]) -> bytes:
+        digest = hashlib.blake2b(digest_size=16)
+        for line in string_table:
+            digest.update(' '.join(line).encode('utf-8'))
+            digest.update(b'\n')
+        return digest.digest()
+
+    def get(self, string_table: List[List[str]], parse: Callable[[List[List[str]]], Any]) -> Any:
+        return self.lookup(self.key(string_table), lambda: parse(string_table))
+
+    def lookup(self, key: Any, load: Callable[[], Any]) -> Any:
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+        value = load()
+        if value is not None:
+            self.put(key, value)
+        return value
+
+    def put(self, key: Any, value: Any) -> None:
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+PARSE_CACHE = ParseCache(PARSE_CACHE_SIZE)
+KEYFRAMES = ParseCache(KEYFRAME_CACHE_SIZE)
+
+
+def _keyframe_path(keyframe_id: str) -> Optional[str]:
+    if not keyframe_id.isalnum():
+        return None
+    return os.path.join(KEYFRAME_DIR, f"{keyframe_id}.json")
+
+
+def _store_keyframe(keyframe_id: str, data: Dict) -> None:
+    KEYFRAMES.put(keyframe_id, data)
+    path = _keyframe_path(keyframe_id)
+    if path is None or os.path.exists(path):
+        return
+    try:
+        os.makedirs(KEYFRAME_DIR, exist_ok=True)
+        with open(f"{path}.{os.getpid()}.tmp", 'w', encoding='utf-8') as keyframe_file:
+            json.dump(data, keyframe_file)
+        os.replace(keyframe_file.name, path)
+    except OSError:
+        pass
+
+
+def _read_keyframe(keyframe_id: str) -> Optional[Dict]:
+    path = _keyframe_path(keyframe_id)
+    try:
+        with open(path, encoding='utf-8') as keyframe_file:
+            return json.load(keyframe_file)
+    except (TypeError, OSError, ValueError):
+        return None
+
+
+def _apply_delta(data: Any, delta: Dict) -> Any:
+    if '=' in delta:
+        return delta['=']
+    if 'l' in delta:
+        data = list(data)
+        for index, change in delta['l'].items():
+            data[int(index)] = _apply_delta(data[int(index)], change)
+        return data
+    data = {key: value for key, value in data.items() if key not in delta.get('r', ())}
+    for key, change in delta['d'].items():
+        data[key] = _apply_delta(data.get(key), change)
+    return data
+
+
+class RingBuffer:
+    """Fixed number of (timestamp, value) integer samples, thinned to one per min_interval bucket, kept in one flat array for the value store"""
+    def __init__(self, size: int, stored: Optional[Tuple] = None) -> None:
+        self._size = size
+        self._data = array('q', bytes(16 * size))
+        self._head = 0
+        self._count = 0
+        self._bucket_start = 0
+        if stored and len(stored) == 5 and stored[0] == size and len(stored[3]) == 2 * size:
+            _size, self._head, self._count, values, self._bucket_start = stored
+            self._data = array('q', values)
+
+    def append(self, timestamp: float, value: float, min_interval: float = 0) -> None:
+        if self._count and timestamp - self._bucket_start < min_interval:
+            self._head = (self._head - 1) % self._size
+            self._count -= 1
+        else:
+            self._bucket_start = int(timestamp)
+        self._data[2 * self._head] = int(timestamp)
+        self._data[2 * self._head + 1] = int(value)
+        self._head = (self._head + 1) % self._size
+        self._count = min(self._count + 1, self._size)
+
+    def samples(self, since: float = 0) -> List[Tuple[int, int]]:
+        slots = ((self._head - self._count + index) % self._size for index in range(self._count))
+        return [(self._data[2 * slot], self._data[2 * slot + 1]) for slot in slots if self._data[2 * slot] >= since]
+
+    def dump(self) -> Tuple:
+        return self._size, self._head, self._count, tuple(self._data), self._bucket_start
+
+
+def _slope(samples: List[Tuple[int, int]]) -> Optional[float]:
+    if len(samples) < 2:
+        return None
+    mean_t = sum(t for t, _v in samples) / len(samples)
+    mean_v = sum(v for _t, v in samples) / len(samples)
+    variance = sum((t - mean_t) ** 2 for t, _v in samples)
+    if not variance:
+        return None
+    return sum((t - mean_t) * (v - mean_v) for t, v in samples) / variance
+
+
+def _percentile(values: List[float], percent: float) -> float:
+    ordered = sorted(values)
+    return ordered[max(math.ceil(percent / 100 * len(ordered)) - 1, 0)]
+
+
+class PrimaryStatus(NamedTuple):
+    instance_name: str
+    database: str
+    last_backup_file: Optional[str]
+    last_backup_date_utc: datetime
+    last_backup_age: Optional[int] = None
+
+
+class SecondaryStatus(NamedTuple):
+    instance_name: str
+    database: str
+    last_copied_file: Optional[str]
+    last_restored_file: Optional[str]
+    last_restored_date_utc: datetime
+    last_restored_age: Optional[int] = None
+
+
+class Host(NamedTuple):
+    status: Dict[str, Any]
+    jobs: List[Dict]
+    server_current_time: Optional[datetime]
+    error: Optional[str] = None
+    events: Optional[Dict[str, Dict]] = None
+    circuit: Optional[Dict[str, Any]] = None
+
+
+class Pair(NamedTuple):
+    name: Optional[str]
+    primary: Optional[Host]
+    secondary: Optional[Host]
+    clock_offset: Optional[timedelta]
+    databases: List[str]
+    lag: Optional[Dict[str, Dict]] = None
+    links: Optional[Dict[str, Tuple[str, Optional[int]]]] = None
+
+
+class Section(NamedTuple):
+    pairs: List[Pair]
+    items: Dict[str, Tuple[Pair, str]]
+
+
+def _parse_primary_status(row: Dict) -> PrimaryStatus:
+    return PrimaryStatus(
+        instance_name=row['instance_name'],
+        database=row['primary_database'],
+        last_backup_file=row['last_backup_file'],
+        last_backup_date_utc=_parse_timestamp(row['last_backup_date_utc']),
+        last_backup_age=row.get('last_backup_age'),
+    )
+
+
+def _parse_secondary_status(row: Dict) -> SecondaryStatus:
+    return SecondaryStatus(
+        instance_name=row['instance_name'],
+        database=row['secondary_database'],
+        last_copied_file=row['last_copied_file'],
+        last_restored_file=row['last_restored_file'],
+        last_restored_date_utc=_parse_timestamp(row['last_restored_date_utc']),
+        last_restored_age=row.get('last_restored_age'),
+    )
+
+
+def _parse_host(data: Optional[Dict], parse_status: Callable[[Dict], Any]) -> Optional[Host]:
+    if not data:
+        return None
+    if 'error' in data:
+        return Host(status={}, jobs=[], server_current_time=None, error=data['error'], circuit=data.get('circuit'))
+    statuses = (parse_status(row) for row in data['status'])
+    return Host(
+        status={status.database: status for status in statuses},
+        jobs=data['jobs'],
+        server_current_time=_parse_timestamp(data['server_current_time']['server_current_time']) if 'server_current_time' in data else None,
+        events={row['database']: row for row in data['events']} if 'events' in data else None,
+        circuit=data.get('circuit'),
+    )
+
+
+def _parse_pair(name: Optional[str], data: Dict) -> Pair:
+    primary = _parse_host(data.get('primary'), _parse_primary_status)
+    secondary = _parse_host(data.get('secondary'), _parse_secondary_status)
+    clock_offset = None
+    databases = []
+    links = {link['secondary_database']: (link['primary_database'], link['restore_threshold']) for link in data['links']} if 'links' in data else None
+    if primary and secondary and not primary.error and not secondary.error:
+        if primary.server_current_time and secondary.server_current_time:
+            clock_offset = abs(primary.server_current_time - secondary.server_current_time)
+        if links is None:
+            databases = get_exclusive_database_names(primary, secondary)
+        else:
+            databases = [database for database, (primary_database, _threshold) in links.items() if primary_database in primary.status and database in secondary.status]
+    lag = {row['database']: row for row in data['lag']} if 'lag' in data else None
+    return Pair(name=name, primary=primary, secondary=secondary, clock_offset=clock_offset, databases=databases, lag=lag, links=links)
+
+
+def _item_name(pair: Pair, database: str) -> str:
+    return database if pair.name is None else f"{pair.name} {database}"
+
+
+def parse_mssql_log_shipping(string_table: List[List[str]]) -> Optional[Section]:
+    return PARSE_CACHE.get(string_table, _parse_section)
+
+
+def _decode_payload(string_table: List[List[str]]) -> Dict:
+    if string_table and string_table[0] == ['2']:
+        data = json.loads(_decode_lines(string_table[1:]))
+        return _decode_columnar(data['d'], data['s'])
+    return json.loads(_decode_lines(string_table))
+
+
+def _decode_section(string_table: List[List[str]]) -> Optional[Dict]:
+    header = string_table[0] if string_table else []
+    if len(header) == 2 and header[0] == 'k':
+        data = _decode_payload(string_table[1:])
+        _store_keyframe(header[1], data)
+        return data
+    if len(header) == 3 and header[0] == 'd':
+        keyframe = KEYFRAMES.lookup(header[1], lambda: _read_keyframe(header[1]))
+        if keyframe is None:
+            return None
+        return _apply_delta(keyframe, json.loads(_decode_lines(string_table[1:])))
+    return _decode_payload(string_table)
+
+
+def _parse_section(string_table: List[List[str]]) -> Optional[Section]:
+    data = _decode_section(string_table)
+    if data is None:
+        return None
+
+    if 'pairs' in data:
+        pairs = [_parse_pair(pair['name'], pair) for pair in data['pairs']]
+    else:
+        pairs = [_parse_pair(None, data)]
+    items = {}
+    for pair in pairs:
+        if pair.links is not None:
+            for database in pair.links:
+                items.setdefault(_item_name(pair, database), (pair, database))
+            continue
+        for host in (pair.primary, pair.secondary):
+            for database in host.status if host else ():
+                items.setdefault(_item_name(pair, database), (pair, database))
+    return Section(pairs=pairs, items=items)
 
 
 def find_duplicates(*lists: List[List[Any]]) -> List[Any]:
@@ -39,17 +358,26 @@ def find_duplicates(*lists: List[List[Any]]) -> List[Any]:
     return [item for item, count in counter.items() if count > 1]
 
 
-def get_exclusive_database_names(primary: Dict, secondary: Dict) -> List[Any]:
-    p_databases = [status["primary_database"] for status in primary["status"]]
-    s_databases = [status["secondary_database"] for status in secondary["status"]]
-    return find_duplicates(p_databases, s_databases)
+def get_exclusive_database_names(primary: Host, secondary: Host) -> List[Any]:
+    return find_duplicates(list(primary.status), list(secondary.status))
+
 
+def _find_pair(item: str, section: Section) -> Tuple[Optional[Pair], Optional[str]]:
+    if item in section.items:
+        return section.items[item]
+    for pair in section.pairs:
+        if pair.name is None:
+            return pair, item
+        prefix = f"{pair.name} "
+        if item.startswith(prefix):
+            return pair, item[len(prefix):]
+    return None, None
 
-def discover_mssql_log_shipping_plugin(section):
-    primary_data = section.get('primary')
-    secondary_data = section.get('secondary')
-    for database in get_exclusive_database_names(primary_data, secondary_data):
-        yield Service(item=database)
+
+def discover_mssql_log_shipping_plugin(section: Section):
+    for pair in section.pairs:
+        for database in pair.databases:
+            yield Service(item=_item_name(pair, database))
 
 
 def _agregate_results(state_list: List[State], **kwargs: Any):
@@ -59,38 +387,134 @@ def _agregate_results(state_list: List[State], **kwargs: Any):
     yield metric
 
 
-def check_mssql_log_shipping_plugin(item, params, section):
-    primary_data = section.get('primary')
-    secondary_data = section.get('secondary')
-    if not primary_data or not secondary_data:
-        if not primary_data:
+def check_mssql_log_shipping_plugin(item, params, section: Section):
+    pair, database = _find_pair(item, section)
+    if pair is None:
+        return
+    yield from _check_pair(database, params, pair, get_value_store())
+
+
+def _age(age: Optional[int], timestamp: datetime, now: datetime) -> float:
+    return float(age) if age is not None else abs(now - timestamp).total_seconds()
+
+
+def _check_unreachable(item: str, primary_database: str, params, pair: Pair):
+    now = datetime.now(timezone.utc)
+    if pair.primary.error:
+        yield Result(state=State.CRIT, summary=f"Primary unreachable: {pair.primary.error}")
+    elif primary_database in pair.primary.status:
+        primary_status = pair.primary.status[primary_database]
+        yield from check_levels(
+            value = _age(primary_status.last_backup_age, primary_status.last_backup_date_utc, now),
+            levels_upper = params['time_since_last_backup_upper'],
+            metric_name = 'mssql_log_shipping_time_since_last_backup',
+            label = 'Time Since Last Log Backup',
+            render_func = lambda v: render.timespan(v),
+        )
+
+    if pair.secondary.error:
+        yield Result(state=State.CRIT, summary=f"Secondary unreachable: {pair.secondary.error}")
+    elif item in pair.secondary.status:
+        secondary_status = pair.secondary.status[item]
+        yield from check_levels(
+            value = _age(secondary_status.last_restored_age, secondary_status.last_restored_date_utc, now),
+            levels_upper = _restore_levels(params, pair, item),
+            metric_name = 'mssql_log_shipping_time_since_last_restore',
+            label = 'Time Since Last Restore',
+            render_func = lambda v: render.timespan(v),
+        )
+
+
+def _gap_trend(params, value_store, gap: float, now: float) -> Tuple[Optional[float], List]:
+    window = params.get('trend_window', 3600)
+    buffer = RingBuffer(GAP_SAMPLES, value_store.get('gap_samples'))
+    buffer.append(now, gap, window / GAP_SAMPLES)
+    value_store['gap_samples'] = buffer.dump()
+    samples = buffer.samples(now - window)
+
+    slope = _slope(samples)
+    if slope is None:
+        return None, [Result(state=State.OK, notice='Gap trend: not enough samples yet')]
+    results = list(check_levels(
+        value = slope * 3600,
+        levels_upper = params.get('gap_growth_upper'),
+        label = 'Gap Growth',
+        render_func = lambda v: f"{'+' if v >= 0 else '-'}{render.timespan(abs(v))}/h",
+        notice_only = True,
+    ))
+    crit = params['gap_upper'][1]
+    if gap >= crit or slope > 0:
+        results += check_levels(
+            value = (crit - gap) / slope if gap < crit else 0,
+            levels_lower = params.get('gap_time_to_crit_lower'),
+            metric_name = 'mssql_log_shipping_gap_time_to_crit',
+            label = 'Gap Projected Time To CRIT',
+            render_func = lambda v: render.timespan(v),
+            notice_only = True,
+        )
+    results += check_levels(
+        value = _percentile([value for _timestamp, value in samples], 95),
+        levels_upper = params.get('gap_p95_upper'),
+        metric_name = 'mssql_log_shipping_gap_p95',
+        label = f"Gap 95th Percentile ({render.timespan(window)})",
+        render_func = lambda v: render.timespan(v),
+        notice_only = True,
+    )
+    return slope, results
+
+
+def _primary_database(pair: Pair, item: str) -> str:
+    return pair.links[item][0] if pair.links and item in pair.links else item
+
+
+def _restore_levels(params, pair: Pair, item: str) -> Tuple[float, float]:
+    threshold = pair.links[item][1] if pair.links and item in pair.links else None
+    if params.get('use_restore_threshold') and threshold:
+        return threshold, threshold
+    return params['time_since_last_restore_upper']
+
+
+def _database_times(pair: Pair, primary_status: PrimaryStatus, secondary_status: SecondaryStatus, now: datetime) -> Tuple[float, float, float]:
+    if primary_status.last_backup_age is not None and secondary_status.last_restored_age is not None:
+        return (
+            float(abs(primary_status.last_backup_age - secondary_status.last_restored_age)),
+            float(secondary_status.last_restored_age),
+            float(primary_status.last_backup_age),
+        )
+    gap = abs((secondary_status.last_restored_date_utc - primary_status.last_backup_date_utc) - (pair.clock_offset or timedelta(0)))
+    return (
+        gap.total_seconds(),
+        abs(now - secondary_status.last_restored_date_utc).total_seconds(),
+        abs(now - primary_status.last_backup_date_utc).total_seconds(),
+    )
+
+
+def _check_pair(item: str, params, pair: Pair, value_store: Optional[Dict] = None):
+    if not pair.primary or not pair.secondary:
+        if not pair.primary:
             yield Result(state=State.CRIT, summary='Primary data not found')
-        if not secondary_data:
+        if not pair.secondary:
             yield Result(state=State.CRIT, summary='Secondary data not found')
         return
 
-    primary_status = next(filter(lambda d: d.get('primary_database') == item, primary_data['status']), None)
-    secondary_status = next(filter(lambda d: d.get('secondary_database') == item, secondary_data['status']), None)
+    yield from _check_circuits(params, pair)
 
-    if not primary_status or not secondary_status:
+    if pair.primary.error or pair.secondary.error:
+        yield from _check_unreachable(item, _primary_database(pair, item), params, pair)
         return
 
-    last_backup_date_utc = datetime.fromisoformat(primary_status['last_backup_date_utc']).replace(tzinfo=timezone.utc)
-    last_restored_date_utc = datetime.fromisoformat(secondary_status['last_restored_date_utc']).replace(tzinfo=timezone.utc)
+    primary_status = pair.primary.status.get(_primary_database(pair, item))
+    secondary_status = pair.secondary.status.get(item)
 
-    primary_server_current_time = datetime.fromisoformat(primary_data['server_current_time']['server_current_time']).replace(tzinfo=timezone.utc)
-    secondary_server_current_time = datetime.fromisoformat(secondary_data['server_current_time']['server_current_time']).replace(tzinfo=timezone.utc)
-    diff_current_time = abs(primary_server_current_time - secondary_server_current_time)
+    if not primary_status or not secondary_status:
+        return
 
-    diff = abs((last_restored_date_utc - last_backup_date_utc) - diff_current_time)
-    diff_seconds = diff.total_seconds()
+    diff_seconds, time_since_last_restore, time_since_last_backup = _database_times(pair, primary_status, secondary_status, datetime.now(timezone.utc))
 
-    time_since_last_restore = abs(datetime.now(timezone.utc) - last_restored_date_utc)
-    time_since_last_backup = abs(datetime.now(timezone.utc) - last_backup_date_utc)
+    slope, trend_results = _gap_trend(params, value_store, diff_seconds, time.time()) if value_store is not None else (None, [])
 
     state_list = []
-    yield from _agregate_results(
-        state_list,
+    gap_result, gap_metric = check_levels(
         value = diff_seconds,
         levels_upper = params['gap_upper'],
         metric_name = 'mssql_log_shipping_gap',
@@ -98,11 +522,20 @@ def check_mssql_log_shipping_plugin(item, params, section):
         render_func = lambda v: render.timespan(v),
         notice_only = True,
     )
+    if gap_result.state == State.WARN and params.get('gap_ignore_shrinking') and slope is not None and slope < 0:
+        gap_result = Result(state=State.OK, notice=f"{gap_result.details} (shrinking)")
+    state_list.append(gap_result.state)
+    yield gap_result
+    yield gap_metric
+    for result in trend_results:
+        if isinstance(result, Result):
+            state_list.append(result.state)
+        yield result
 
     yield from _agregate_results(
         state_list,
-        value = time_since_last_restore.total_seconds(),
-        levels_upper = params['time_since_last_restore_upper'],
+        value = time_since_last_restore,
+        levels_upper = _restore_levels(params, pair, item),
         metric_name = 'mssql_log_shipping_time_since_last_restore',
         label = 'Time Since Last Restore',
         render_func = lambda v: render.timespan(v),
@@ -111,7 +544,7 @@ def check_mssql_log_shipping_plugin(item, params, section):
 
     yield from _agregate_results(
         state_list,
-        value = time_since_last_backup.total_seconds(),
+        value = time_since_last_backup,
         levels_upper = params['time_since_last_backup_upper'],
         metric_name = 'mssql_log_shipping_time_since_last_backup',
         label = 'Time Since Last Log Backup',
@@ -119,13 +552,265 @@ def check_mssql_log_shipping_plugin(item, params, section):
         notice_only = True,
     )
 
-    details = f"\nLast Backup File: {primary_status['last_backup_file']}\nLast Copied File: {secondary_status['last_copied_file']}\nLast Restored File: {secondary_status['last_restored_file']}"
+    if pair.lag is not None and item in pair.lag:
+        yield from _check_lag(params, pair.lag[item])
+
+    if pair.secondary.events is not None:
+        yield from _check_events(params, pair.secondary.events.get(item))
+
+    details = f"\nLast Backup File: {primary_status.last_backup_file}\nLast Copied File: {secondary_status.last_copied_file}\nLast Restored File: {secondary_status.last_restored_file}"
     if State.worst(*state_list) == State.OK:
         yield Result(state=State.OK, summary='Synchronized databases', details=details)
     elif State.worst(*state_list) == State.CRIT:
         yield Result(state=State.CRIT, summary='Desynchronized databases', details=details)
 
 
+def _check_circuits(params, pair: Pair):
+    now = time.time()
+    for role, host in (('Primary', pair.primary), ('Secondary', pair.secondary)):
+        if host.circuit is None or host.error:
+            continue
+        yield Result(
+            state=State(params.get('circuit_open_state', 1)),
+            summary=f"{role} circuit open, data from {render.timespan(now - host.circuit['good_at'])} ago",
+            details=f"{role} skipped after {host.circuit['failures']} failed connections, next probe in {render.timespan(max(host.circuit['probe_at'] - now, 0))}. Last error: {host.circuit['error']}",
+        )
+
+
+def _check_lag(params, lag: Dict):
+    yield from check_levels(
+        value = lag['pending_backups'],
+        levels_upper = params.get('pending_backups_upper'),
+        metric_name = 'mssql_log_shipping_pending_backups',
+        label = 'Pending Log Backups',
+        render_func = lambda v: f"{v:.0f}",
+    )
+    yield from check_levels(
+        value = lag['pending_bytes'],
+        levels_upper = params.get('pending_bytes_upper'),
+        metric_name = 'mssql_log_shipping_pending_bytes',
+        label = 'Pending Bytes',
+        render_func = lambda v: render.bytes(v),
+    )
+    if lag['restore_rate'] is None:
+        yield Result(state=State.OK, notice='Restore throughput: no restores in the last hour')
+        return
+    yield from check_levels(
+        value = lag['restore_rate'],
+        metric_name = 'mssql_log_shipping_restore_rate',
+        label = 'Restore Throughput',
+        render_func = lambda v: render.iobandwidth(v),
+        notice_only = True,
+    )
+    if lag['restore_rate'] > 0:
+        yield from check_levels(
+            value = lag['pending_bytes'] / lag['restore_rate'],
+            levels_upper = params.get('catch_up_time_upper'),
+            metric_name = 'mssql_log_shipping_catch_up_time',
+            label = 'Estimated Catch-up Time',
+            render_func = lambda v: render.timespan(v),
+            notice_only = not lag['pending_bytes'],
+        )
+
+
+def _check_events(params, events: Optional[Dict]):
+    events = events or {}
+    for event, label in (('copy', 'Failed Copies'), ('restore', 'Failed Restores')):
+        yield from check_levels(
+            value = events.get(f"{event}_failed", 0),
+            levels_upper = params[f"{event}_failures_upper"],
+            metric_name = f"mssql_log_shipping_{event}_failures",
+            label = label,
+            render_func = lambda v: f"{v:.0f}",
+            notice_only = not events.get(f"{event}_failed"),
+        )
+    yield Result(
+        state=State.OK,
+        notice=f"Since last run: {events.get('copy_success', 0)} successful copies, {events.get('restore_success', 0)} successful restores",
+    )
+    if events.get('last_error'):
+        yield Result(state=State.OK, notice=f"Last error ({_parse_timestamp(events['last_error_date_utc']).isoformat()}): {events['last_error']}")
+
+
+def discover_mssql_log_shipping_summary(section: Section):
+    if any(pair.databases for pair in section.pairs):
+        yield Service()
+
+
+def _pair_errors(pair: Pair) -> List[str]:
+    errors = []
+    for role, host in (('Primary', pair.primary), ('Secondary', pair.secondary)):
+        if not host:
+            errors.append(f"{role} data not found")
+        elif host.error:
+            errors.append(f"{role} unreachable: {host.error}")
+    return errors
+
+
+def check_mssql_log_shipping_summary(params, section: Section):
+    now = datetime.now(timezone.utc)
+    states = Counter()
+    gaps, restores, backups = [], [], []
+    worst_item, worst_gap = None, None
+    failed = {}
+    for pair in section.pairs:
+        errors = _pair_errors(pair)
+        if errors:
+            failed[pair.name or 'Pair'] = errors
+            continue
+        for database in pair.databases:
+            primary_status = pair.primary.status[_primary_database(pair, database)]
+            secondary_status = pair.secondary.status[database]
+            gap, restore, backup = _database_times(pair, primary_status, secondary_status, now)
+            states[State.worst(*(
+                next(check_levels(value, levels_upper=levels)).state
+                for value, levels in ((gap, params['gap_upper']), (restore, _restore_levels(params, pair, database)), (backup, params['time_since_last_backup_upper']))
+            ))] += 1
+            gaps.append(gap)
+            restores.append(restore)
+            backups.append(backup)
+            if worst_gap is None or gap > worst_gap:
+                worst_item, worst_gap = _item_name(pair, database), gap
+
+    yield Result(state=State.OK, summary=f"Databases: {sum(states.values())} ({states[State.OK]} OK, {states[State.WARN]} WARN, {states[State.CRIT]} CRIT)")
+    for state, name in ((State.OK, 'ok'), (State.WARN, 'warn'), (State.CRIT, 'crit')):
+        yield from check_levels(
+            value = states[state],
+            levels_upper = params.get(f"{name}_databases_upper"),
+            metric_name = f"mssql_log_shipping_summary_{name}_databases",
+            label = f"{state.name} Databases",
+            render_func = lambda v: f"{v:.0f}",
+            notice_only = True,
+        )
+    yield from check_levels(
+        value = len(failed),
+        levels_upper = params.get('failed_pairs_upper'),
+        metric_name = 'mssql_log_shipping_summary_failed_pairs',
+        label = f"Failed Pairs (of {len(section.pairs)})",
+        render_func = lambda v: f"{v:.0f}",
+        notice_only = not failed,
+    )
+    for name, errors in failed.items():
+        yield Result(state=State.OK, notice=f"{name}: {', '.join(errors)}")
+    if worst_item is None:
+        return
+    yield from check_levels(
+        value = worst_gap,
+        levels_upper = params.get('gap_max_upper'),
+        metric_name = 'mssql_log_shipping_summary_gap_max',
+        label = f"Worst Gap ({worst_item})",
+        render_func = lambda v: render.timespan(v),
+    )
+    for values, name, label in ((gaps, 'gap', 'Gap'), (restores, 'time_since_last_restore', 'Time Since Last Restore'), (backups, 'time_since_last_backup', 'Time Since Last Log Backup')):
+        for percent in (50, 95):
+            yield from check_levels(
+                value = _percentile(values, percent),
+                levels_upper = params.get(f"{name}_p{percent}_upper"),
+                metric_name = f"mssql_log_shipping_summary_{name}_p{percent}",
+                label = f"{label} {percent}th Percentile",
+                render_func = lambda v: render.timespan(v),
+                notice_only = True,
+            )
+        if name != 'gap':
+            yield from check_levels(
+                value = max(values),
+                levels_upper = params.get(f"{name}_max_upper"),
+                metric_name = f"mssql_log_shipping_summary_{name}_max",
+                label = f"Maximum {label}",
+                render_func = lambda v: render.timespan(v),
+                notice_only = True,
+            )
+
+
+def parse_mssql_log_shipping_agent(string_table: List[List[str]]) -> Dict:
+    return json.loads(string_table[0][0]) if string_table else {}
+
+
+def discover_mssql_log_shipping_agent(section: Dict):
+    if section:
+        yield Service()
+
+
+def check_mssql_log_shipping_agent(params, section: Dict):
+    yield from check_levels(
+        value = section['run_time'],
+        levels_upper = params.get('run_time_upper'),
+        metric_name = 'mssql_log_shipping_agent_run_time',
+        label = 'Run Time',
+        render_func = lambda v: render.timespan(v),
+    )
+    for key, label in (('raw_bytes', 'Raw Payload'), ('compressed_bytes', 'Compressed Payload'), ('encoded_bytes', 'Encoded Payload')):
+        yield from check_levels(
+            value = section[key],
+            metric_name = f"mssql_log_shipping_agent_{key}",
+            label = label,
+            render_func = lambda v: render.bytes(v),
+            notice_only = True,
+        )
+    failed = [host for host, data in section['hosts'].items() if 'error' in data]
+    yield Result(state=State.OK, summary=f"Hosts: {len(section['hosts'])}, failed: {len(failed)}")
+
+
+def discover_mssql_log_shipping_agent_host(section: Dict):
+    for host in section.get('hosts', {}):
+        yield Service(item=host)
+
+
+def check_mssql_log_shipping_agent_host(item, params, section: Dict):
+    host = section.get('hosts', {}).get(item)
+    if host is None:
+        return
+    if 'circuit' in host:
+        yield from _check_circuit_host(params, host['circuit'])
+        return
+    if 'error' in host:
+        yield Result(state=State.CRIT, summary=f"Collection failed: {host['error']}")
+        return
+
+    yield from check_levels(
+        value = host['connect_time'],
+        levels_upper = params.get('connect_time_upper'),
+        metric_name = 'mssql_log_shipping_agent_connect_time',
+        label = 'Connect Time',
+        render_func = lambda v: render.timespan(v),
+    )
+    queries = host['queries']
+    yield from check_levels(
+        value = host.get('batch_time', sum(query.get('time', 0) for query in queries.values())),
+        levels_upper = params.get('query_time_upper'),
+        metric_name = 'mssql_log_shipping_agent_query_time',
+        label = 'Query Time',
+        render_func = lambda v: render.timespan(v),
+    )
+    yield from check_levels(
+        value = sum(query['rows'] for query in queries.values()),
+        metric_name = 'mssql_log_shipping_agent_rows',
+        label = 'Rows',
+        render_func = lambda v: f"{v:.0f}",
+    )
+    details = [
+        f"{name}: {query['rows']} rows" + (f" in {render.timespan(query['time'])}" if 'time' in query else '')
+        for name, query in queries.items()
+    ]
+    if host.get('cached'):
+        details.append(f"Cached: {', '.join(host['cached'])}")
+    if details:
+        yield Result(state=State.OK, notice='\n'.join(details))
+
+
+def _check_circuit_host(params, circuit: Dict):
+    now = time.time()
+    yield Result(
+        state=State(params.get('circuit_open_state', 2)),
+        summary=f"Circuit open after {circuit['failures']} failed connections, next probe in {render.timespan(max(circuit['probe_at'] - now, 0))}",
+        details=f"Last error: {circuit['error']}",
+    )
+    if circuit['good_at'] is None:
+        yield Result(state=State.OK, summary='No data collected yet')
+    else:
+        yield Result(state=State.OK, summary=f"Last known good data from {render.timespan(now - circuit['good_at'])} ago")
+
+
 register.agent_section(
     name = 'mssql_log_shipping',
     parse_function = parse_mssql_log_shipping,
@@ -141,6 +826,52 @@ register.check_plugin(
         'gap_upper': (900, 1800),
         'time_since_last_restore_upper': (3600, 7200),
         'time_since_last_backup_upper': (3600, 7200),
+        'copy_failures_upper': (1, 3),
+        'restore_failures_upper': (1, 3),
     },
     check_ruleset_name='mssql_log_shipping'
 )
+
+
+register.check_plugin(
+    name = 'mssql_log_shipping_summary',
+    sections = ['mssql_log_shipping'],
+    service_name = 'MSSQL Log Shipping Summary',
+    discovery_function = discover_mssql_log_shipping_summary,
+    check_function = check_mssql_log_shipping_summary,
+    check_default_parameters={
+        'gap_upper': (900, 1800),
+        'time_since_last_restore_upper': (3600, 7200),
+        'time_since_last_backup_upper': (3600, 7200),
+        'crit_databases_upper': (1, 1),
+        'failed_pairs_upper': (1, 1),
+    },
+    check_ruleset_name='mssql_log_shipping_summary'
+)
+
+
+register.agent_section(
+    name = 'mssql_log_shipping_agent',
+    parse_function = parse_mssql_log_shipping_agent,
+)
+
+
+register.check_plugin(
+    name = 'mssql_log_shipping_agent',
+    service_name = 'MSSQL Log Shipping Agent',
+    discovery_function = discover_mssql_log_shipping_agent,
+    check_function = check_mssql_log_shipping_agent,
+    check_default_parameters={},
+    check_ruleset_name='mssql_log_shipping_agent'
+)
+
+
+register.check_plugin(
+    name = 'mssql_log_shipping_agent_host',
+    sections = ['mssql_log_shipping_agent'],
+    service_name = 'MSSQL Log Shipping Agent %s',
+    discovery_function = discover_mssql_log_shipping_agent_host,
+    check_function = check_mssql_log_shipping_agent_host,
+    check_default_parameters={},
+    check_ruleset_name='mssql_log_shipping_agent_host'
+)
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8; py-indent-offset: 4 -*-
+# Checkmk special agent for MSSQL Log Shipping (https://github.com/Fyotta/checkmk-mssql-log-shipping) - Francisco Fernandes <franciscoyotta@gmail.com>
+# This code is distributed under the terms of the GNU General Public License, version 3 (GPLv3).
+# See the LICENSE file for details on the license terms.
+"""Benchmark of the agent pipeline and the check plugin with synthetic fleet-scale data"""
+import argparse
+import json
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from unittest import mock
+
+from fake_mssql_driver import FakeDriver, agent_mssql_log_shipping, generate_rows
+
+try:
+    from cmk.base.plugins.agent_based import mssql_log_shipping as check_plugin
+except ImportError:
+    check_plugin = None
+
+CHECK_PARAMETERS = {
+    'gap_upper': (900, 1800),
+    'time_since_last_restore_upper': (3600, 7200),
+    'time_since_last_backup_upper': (3600, 7200),
+}
+
+
+def measure(function: Callable[[], Any], repeat: int) -> Tuple[Dict[str, float], Any]:
+    timings = []
+    for _run in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    tracemalloc.start()
+    function()
+    _current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'best_seconds': min(timings), 'mean_seconds': sum(timings) / len(timings), 'peak_bytes': peak}, result
+
+
+def run_benchmark(databases: int, jobs: int, message_size: int, repeat: int, section_format: int) -> Dict[str, Any]:
+    rows = generate_rows(databases, jobs, message_size)
+    query = agent_mssql_log_shipping.QUERY
+    stages = {}
+
+    def map_results():
+        return {
+            'primary': {
+                'status': agent_mssql_log_shipping.map_many_results(query['get_primary_status']['columns'], rows['get_primary_status']),
+                'jobs': agent_mssql_log_shipping.map_many_results(query['get_jobs']['columns'], rows['get_jobs']),
+                'server_current_time': agent_mssql_log_shipping.map_one_result(query['get_server_current_time']['columns'], rows['get_server_current_time'][0]),
+            },
+            'secondary': {
+                'status': agent_mssql_log_shipping.map_many_results(query['get_secondary_status']['columns'], rows['get_secondary_status']),
+                'jobs': agent_mssql_log_shipping.map_many_results(query['get_jobs']['columns'], rows['get_jobs']),
+                'server_current_time': agent_mssql_log_shipping.map_one_result(query['get_server_current_time']['columns'], rows['get_server_current_time'][0]),
+            },
+        }
+    stages['map_many_results'], data = measure(map_results, repeat)
+    stages['encode_section'], payload = measure(lambda: agent_mssql_log_shipping.encode_section(data, section_format), repeat)
+    stages['encode_section']['output_bytes'] = len(payload)
+
+    if check_plugin is not None:
+        string_table = [line.split() for line in payload.splitlines()]
+        stages['parse_mssql_log_shipping'], section = measure(lambda: check_plugin._parse_section(string_table), repeat)
+        check_plugin.PARSE_CACHE.clear()
+        stages['parse_cached'], _section = measure(lambda: check_plugin.parse_mssql_log_shipping(string_table), repeat)
+        stages['discovery'], services = measure(lambda: list(check_plugin.discover_mssql_log_shipping_plugin(section)), repeat)
+        items = [service.item for service in services]
+        # There is no value store outside of a Checkmk check context, every call gets an empty one
+        with mock.patch.object(check_plugin, 'get_value_store', dict):
+            stages['check_all_items'], _results = measure(
+                lambda: [list(check_plugin.check_mssql_log_shipping_plugin(item, CHECK_PARAMETERS, section)) for item in items],
+                repeat,
+            )
+        stages['check_all_items']['items'] = len(items)
+        stages['check_summary'], _results = measure(lambda: list(check_plugin.check_mssql_log_shipping_summary(CHECK_PARAMETERS, section)), repeat)
+
+    return {
+        'parameters': {'databases': databases, 'jobs': jobs, 'message_size': message_size, 'repeat': repeat, 'section_format': section_format},
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(), 'check_plugin': check_plugin is not None},
+        'timestamp': int(time.time()),
+        'stages': stages,
+    }
+
+
+def run_collection_benchmark(driver: FakeDriver, repeat: int, workers: int, batch: bool, section_format: int) -> Dict[str, Any]:
+    with tempfile.TemporaryDirectory() as state_dir:
+        argv = ['-u', 'benchmark', '-p', 'benchmark', '--state-dir', state_dir, '--workers', str(workers), '--section-format', str(section_format)]
+        for primary, secondary in driver.pairs:
+            argv += ['--pair', agent_mssql_log_shipping.format_address(primary), agent_mssql_log_shipping.format_address(secondary)]
+        args = agent_mssql_log_shipping.parse_arguments(argv + (['--batch'] if batch else []))
+        stage, output = measure(lambda: agent_mssql_log_shipping.get_log_shipping_section(args, driver), repeat)
+    agent_section = json.loads(output.split('<<<mssql_log_shipping_agent:sep(0)>>>\n')[1])
+    stage.update(
+        pairs=len(driver.pairs),
+        hosts=len(agent_section['hosts']),
+        failed_hosts=sum(1 for host in agent_section['hosts'].values() if 'error' in host),
+        connections_per_run=driver.connections // (repeat + 1),
+        queries_per_run=driver.queries // (repeat + 1),
+    )
+    return stage
+
+
+def compare(result: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    regressions = []
+    for stage, values in result['stages'].items():
+        reference = baseline['stages'].get(stage)
+        if not reference:
+            continue
+        for key in ('best_seconds', 'peak_bytes'):
+            if reference[key] and values[key] > reference[key] * (1 + tolerance):
+                regressions.append(f"{stage} {key}: {values[key]:.6g} > {reference[key]:.6g} (+{tolerance:.0%})")
+    return regressions
+
+
+def parse_arguments(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--databases', type=int, default=5000, help='Number of log shipped databases, default 5000')
+    parser.add_argument('--jobs', type=int, default=3000, help='Number of SQL Server Agent jobs per host, default 3000')
+    parser.add_argument('--message-size', type=int, default=200, dest='message_size', help='Length of last_outcome_message in characters, default 200')
+    parser.add_argument('--repeat', type=int, default=5, help='Timed runs per stage, default 5')
+    parser.add_argument('--section-format', type=int, choices=agent_mssql_log_shipping.SECTION_FORMATS, default=2, dest='section_format', help='Section format to encode, default 2')
+    parser.add_argument('--hosts', type=int, default=0, help='Also time get_log_shipping_section against this number of synthetic hosts served by the fake driver, default 0 (skipped)')
+    parser.add_argument('--pairs', type=int, help='Number of primary/secondary pairs over the synthetic hosts, default half the hosts')
+    parser.add_argument('--replay', type=str, help='Time get_log_shipping_section against the hosts and pairs of a file written by the agent with --record')
+    parser.add_argument('--latency', type=float, help='Seconds per login and query of the fake driver, default the recorded timings or 0')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Random seconds added to or removed from every simulated latency, default 0')
+    parser.add_argument('--login-failure-rate', type=float, default=0.0, dest='login_failure_rate', help='Share of logins failing, default 0')
+    parser.add_argument('--timeout-rate', type=float, default=0.0, dest='timeout_rate', help='Share of logins and queries hanging until their timeout, default 0')
+    parser.add_argument('--workers', type=int, default=agent_mssql_log_shipping.DEFAULT_WORKERS, help=f"Workers of the agent, default {agent_mssql_log_shipping.DEFAULT_WORKERS}")
+    parser.add_argument('--batch', action='store_true', help='Collect with batched queries')
+    parser.add_argument('--output', type=str, help='Write the results as JSON to this file')
+    parser.add_argument('--baseline', type=str, help='JSON results of a previous run to compare against, exits with 1 on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed relative slowdown or memory growth against the baseline, default 0.2')
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_arguments(argv)
+    result = run_benchmark(args.databases, args.jobs, args.message_size, args.repeat, args.section_format)
+    if args.hosts or args.replay:
+        options = {
+            'latency': args.latency,
+            'jitter': args.jitter,
+            'login_failure_rate': args.login_failure_rate,
+            'timeout_rate': args.timeout_rate,
+            'seed': 0,
+        }
+        if args.replay:
+            driver = FakeDriver.from_recording(args.replay, **options)
+        else:
+            driver = FakeDriver.synthetic(args.hosts, args.pairs or max(args.hosts // 2, 1), **options)
+        result['parameters'].update(hosts=args.hosts, replay=args.replay, latency=args.latency, jitter=args.jitter, workers=args.workers, batch=args.batch)
+        result['stages']['get_log_shipping_section'] = run_collection_benchmark(driver, args.repeat, args.workers, args.batch, args.section_format)
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output_file:
+            output_file.write(output + '\n')
+    sys.stdout.write(output + '\n')
+    if check_plugin is None:
+        sys.stderr.write('Check plugin not importable (no Checkmk site), parse, discovery and check stages skipped\n')
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as baseline_file:
+            regressions = compare(result, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            sys.stderr.write(f"Regression: {regression}\n")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,191 @@
+# -*- encoding: utf-8; py-indent-offset: 4 -*-
+# Checkmk special agent for MSSQL Log Shipping (https://github.com/Fyotta/checkmk-mssql-log-shipping) - Francisco Fernandes <franciscoyotta@gmail.com>
+# This code is distributed under the terms of the GNU General Public License, version 3 (GPLv3).
+# See the LICENSE file for details on the license terms.
+"""Drop-in replacement of the Mssql class of the special agent answering from recorded or synthetic query results"""
+import datetime
+import os
+import pickle
+import random
+import threading
+import time
+import uuid
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from importlib.util import spec_from_loader, module_from_spec
+from importlib.machinery import SourceFileLoader
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+spec = spec_from_loader('agent_mssql_log_shipping', SourceFileLoader('agent_mssql_log_shipping', os.path.join(SRC_DIR, 'agents', 'special', 'agent_mssql_log_shipping')))
+agent_mssql_log_shipping = module_from_spec(spec)
+spec.loader.exec_module(agent_mssql_log_shipping)
+
+LOGIN_FAILURE = "DB-Lib error message 20009, severity 9:\nUnable to connect: Adaptive Server is unavailable or does not exist ({host})\n"
+TIMEOUT = "DB-Lib error message 20003, severity 6:\nAdaptive Server connection timed out ({host})\n"
+
+
+def query_name(text: str) -> Optional[str]:
+    for name, spec in agent_mssql_log_shipping.QUERY.items():
+        prefix, placeholder, suffix = spec['query'].partition('{since}')
+        if text == spec['query'] or (placeholder and text.startswith(prefix) and text.endswith(suffix)):
+            return name
+    return None
+
+
+def generate_rows(databases: int, jobs: int, message_size: int, seed: int = 0) -> Dict[str, List[Tuple[Any, ...]]]:
+    rnd = random.Random(seed)
+    now = datetime.datetime(2024, 2, 26, 13, 30, 1, 340000)
+    message = ('The job succeeded.  The Job was invoked by Schedule 12 (LSBackupSchedule).  ' * (message_size // 80 + 1))[:message_size]
+    primary_status, secondary_status = [], []
+    for number in range(databases):
+        name = f"DB{number:05d}"
+        backup = now - datetime.timedelta(seconds=rnd.randint(0, 3600))
+        restore = backup - datetime.timedelta(seconds=rnd.randint(0, 1800))
+        primary_status.append((b'MSSQLSERVER', name, f"C:\\LOG\\{name}_{backup:%Y%m%d%H%M%S}.trn", backup - datetime.timedelta(hours=3), backup))
+        secondary_status.append((
+            b'MSSQLSERVER', name, f"C:\\LOG\\{name}_{backup:%Y%m%d%H%M%S}.trn", backup - datetime.timedelta(hours=3), backup,
+            f"C:\\LOG\\{name}_{restore:%Y%m%d%H%M%S}.trn", restore - datetime.timedelta(hours=3), restore,
+        ))
+    job_rows = [
+        (uuid.UUID(int=rnd.getrandbits(128)), f"LSJob_{number:05d}", 1, 20240226, 103000, rnd.randint(0, 1), message, 20240226, 103000, rnd.randint(0, 60), 1)
+        for number in range(jobs)
+    ]
+    return {
+        'get_primary_status': primary_status,
+        'get_secondary_status': secondary_status,
+        'get_primary_status_ages': [row + (int((now - row[4]).total_seconds()),) for row in primary_status],
+        'get_secondary_status_ages': [row + (int((now - row[4]).total_seconds()), int((now - row[7]).total_seconds())) for row in secondary_status],
+        'get_jobs': job_rows,
+        'get_primary_jobs': [row + (f"DB{number:05d}", 'backup') for number, row in enumerate(job_rows[:databases])],
+        'get_secondary_jobs': [row + (f"DB{number // 2:05d}", ('copy', 'restore')[number % 2]) for number, row in enumerate(job_rows[:2 * databases])],
+        'get_server_current_time': [(now,)],
+    }
+
+
+def synthetic_pairs(hosts: int, pairs: int) -> List[Tuple[Tuple[str, int], Tuple[str, int]]]:
+    addresses = [(f"sql{number:04d}", 1433) for number in range(max(hosts, 2))]
+    primaries, secondaries = addresses[:len(addresses) // 2], addresses[len(addresses) // 2:]
+    return [(primaries[number % len(primaries)], secondaries[(number // len(primaries) + number) % len(secondaries)]) for number in range(pairs)]
+
+
+class FakeDriver:
+    """Callable used in place of the Mssql class, connections answer from per host query results with simulated latency and failures"""
+    def __init__(
+        self,
+        hosts: Dict[Tuple[str, int], Dict[str, Any]],
+        latency: Optional[float] = None,
+        jitter: float = 0.0,
+        login_latency: Optional[float] = None,
+        login_failure_rate: float = 0.0,
+        timeout_rate: float = 0.0,
+        failing_hosts: Iterable[str] = (),
+        time_scale: float = 1.0,
+        seed: Optional[int] = None,
+    ) -> None:
+        self.hosts = hosts
+        self.pairs = []
+        self.latency = latency
+        self.jitter = jitter
+        self.login_latency = login_latency
+        self.login_failure_rate = login_failure_rate
+        self.timeout_rate = timeout_rate
+        self.failing_hosts = set(failing_hosts)
+        self.time_scale = time_scale
+        self.connections = 0
+        self.queries = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_recording(cls, path: str, **options: Any) -> 'FakeDriver':
+        with open(path, 'rb') as record_file:
+            recording = pickle.load(record_file)
+        driver = cls(recording['hosts'], **options)
+        driver.pairs = [(tuple(primary), tuple(secondary)) for primary, secondary in recording['pairs']]
+        return driver
+
+    @classmethod
+    def synthetic(cls, hosts: int, pairs: int, databases: int = 10, jobs: int = 20, message_size: int = 200, **options: Any) -> 'FakeDriver':
+        pair_list = synthetic_pairs(hosts, pairs)
+        addresses = dict.fromkeys(address for pair in pair_list for address in pair)
+        driver = cls({address: {'results': generate_rows(databases, jobs, message_size, seed)} for seed, address in enumerate(addresses)}, **options)
+        driver.pairs = pair_list
+        return driver
+
+    def __call__(self, host: str, db_name: str, user: str, pwd: str, port: int = 1433, timeout: int = 0, timeout_connection: int = 60) -> 'FakeConnection':
+        return FakeConnection(self, (host, port), timeout, timeout_connection)
+
+    def count(self, counter: str) -> None:
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def chance(self, rate: float) -> bool:
+        with self._lock:
+            return rate > 0 and self._random.random() < rate
+
+    def sleep(self, recorded: Optional[float], latency: Optional[float] = None) -> None:
+        latency = self.latency if latency is None else latency
+        seconds = (recorded or 0.0) if latency is None else latency
+        if self.jitter:
+            with self._lock:
+                seconds += self._random.uniform(-self.jitter, self.jitter)
+        if seconds > 0:
+            time.sleep(seconds * self.time_scale)
+
+
+class FakeConnection:
+    """Connection of a FakeDriver with the interface of Mssql"""
+    def __init__(self, driver: FakeDriver, address: Tuple[str, int], timeout: int, login_timeout: int) -> None:
+        self._driver = driver
+        self._address = address
+        self._timeout = timeout
+        self._login_timeout = login_timeout
+        self._host = None
+
+    def _timings(self) -> Dict[str, Any]:
+        return self._host.get('timings', {}) if self._host else {}
+
+    def _hang(self, seconds: int) -> None:
+        time.sleep(seconds * self._driver.time_scale)
+        raise Exception(20003, TIMEOUT.format(host=self._address[0]).encode('utf-8'))
+
+    def connect(self) -> None:
+        host = self._driver.hosts.get(self._address)
+        self._driver.sleep(host.get('timings', {}).get('connect_time') if host else None, self._driver.login_latency)
+        if self._driver.chance(self._driver.timeout_rate):
+            self._hang(self._login_timeout)
+        if host is None or 'error' in host or self._address[0] in self._driver.failing_hosts or self._driver.chance(self._driver.login_failure_rate):
+            raise Exception(20009, LOGIN_FAILURE.format(host=self._address[0]).encode('utf-8'))
+        self._driver.count('connections')
+        self._host = host
+
+    def _rows(self, text: str) -> List[Tuple[Any, ...]]:
+        if self._timeout and self._driver.chance(self._driver.timeout_rate):
+            self._hang(self._timeout)
+        self._driver.count('queries')
+        return list(self._host['results'].get(query_name(text), []))
+
+    def set_timeout(self, timeout: int) -> None:
+        self._timeout = timeout
+
+    def execute(self, query: str) -> List[Tuple[Any, ...]]:
+        self._driver.sleep(self._timings().get('queries', {}).get(query_name(query), {}).get('time'))
+        return self._rows(query)
+
+    def execute_batch(self, queries: List[str]) -> List[List[Tuple[Any, ...]]]:
+        self._driver.sleep(self._timings().get('batch_time'))
+        return [self._rows(query) for query in queries]
+
+    def ping(self) -> bool:
+        return self._host is not None
+
+    def disconnect(self) -> None:
+        self._host = None
+
+    def __enter__(self) -> 'FakeConnection':
+        self.connect()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.disconnect()
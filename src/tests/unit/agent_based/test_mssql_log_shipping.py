@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8; py-indent-offset: 4 -*-
+# Checkmk special agent for MSSQL Log Shipping (https://github.com/Fyotta/checkmk-mssql-log-shipping) - Francisco Fernandes <franciscoyotta@gmail.com>
+# This code is distributed under the terms of the GNU General Public License, version 3 (GPLv3).
+# See the LICENSE file for details on the license terms.
+import base64
+import json
+import os
+import time
+import zlib
+from datetime import datetime, timedelta, timezone
+import pytest
+
+from cmk.base.plugins.agent_based import mssql_log_shipping
+from cmk.base.plugins.agent_based.agent_based_api.v1 import Metric, Result, Service, State
+
+
+PARAMS = {
+    'gap_upper': (900, 1800),
+    'time_since_last_restore_upper': (3600, 7200),
+    'time_since_last_backup_upper': (3600, 7200),
+    'copy_failures_upper': (1, 3),
+    'restore_failures_upper': (1, 3),
+}
+
+SUMMARY_PARAMS = {
+    'gap_upper': (900, 1800),
+    'time_since_last_restore_upper': (3600, 7200),
+    'time_since_last_backup_upper': (3600, 7200),
+    'crit_databases_upper': (1, 1),
+    'failed_pairs_upper': (1, 1),
+}
+
+
+def iso(seconds_ago):
+    return (datetime.now(timezone.utc) - timedelta(seconds=seconds_ago)).replace(tzinfo=None).isoformat()
+
+
+def primary_host(*databases, backup_age=300):
+    return {
+        'status': [
+            {'instance_name': 'MSSQLSERVER', 'primary_database': database, 'last_backup_file': f"{database}.trn", 'last_backup_date_utc': iso(backup_age)}
+            for database in databases
+        ],
+        'jobs': [],
+    }
+
+
+def secondary_host(*databases, restore_age=600):
+    return {
+        'status': [
+            {'instance_name': 'MSSQLSERVER', 'secondary_database': database, 'last_copied_file': f"{database}.trn", 'last_restored_file': f"{database}.trn", 'last_restored_date_utc': iso(restore_age)}
+            for database in databases
+        ],
+        'jobs': [],
+    }
+
+
+def encode(data):
+    return [[base64.b64encode(zlib.compress(json.dumps(data).encode('utf-8'))).decode('ascii')]]
+
+
+def parse(data):
+    return mssql_log_shipping._parse_section(encode(data))
+
+
+def results_of(results):
+    return [result for result in results if isinstance(result, Result)]
+
+
+def metrics_of(results):
+    return {metric.name: metric.value for metric in results if isinstance(metric, Metric)}
+
+
+@pytest.fixture
+def value_store(monkeypatch):
+    store = {}
+    monkeypatch.setattr(mssql_log_shipping, 'get_value_store', lambda: store)
+    return store
+
+
+@pytest.fixture
+def keyframes(monkeypatch, tmp_path):
+    monkeypatch.setattr(mssql_log_shipping, 'KEYFRAME_DIR', str(tmp_path))
+    monkeypatch.setattr(mssql_log_shipping, 'KEYFRAMES', mssql_log_shipping.ParseCache(mssql_log_shipping.KEYFRAME_CACHE_SIZE))
+    return tmp_path
+
+
+def test_ring_buffer():
+    buffer = mssql_log_shipping.RingBuffer(3)
+    for timestamp in (100, 200, 300, 400):
+        buffer.append(timestamp, timestamp * 2)
+    assert buffer.samples() == [(200, 400), (300, 600), (400, 800)]
+    assert buffer.samples(since=300) == [(300, 600), (400, 800)]
+
+    buffer.append(410, 1, min_interval=60)
+    assert buffer.samples() == [(200, 400), (300, 600), (410, 1)]
+
+    assert mssql_log_shipping.RingBuffer(3, buffer.dump()).samples() == buffer.samples()
+    assert mssql_log_shipping.RingBuffer(4, buffer.dump()).samples() == []
+
+
+def test_gap_trend_growing():
+    params = dict(PARAMS, trend_window=3600, gap_growth_upper=(600, 1200))
+    store = {}
+    now = int(time.time())
+
+    slope, results = mssql_log_shipping._gap_trend(params, store, 100, now)
+    assert slope is None
+    assert results == [Result(state=State.OK, notice='Gap trend: not enough samples yet')]
+
+    mssql_log_shipping._gap_trend(params, store, 400, now + 600)
+    slope, results = mssql_log_shipping._gap_trend(params, store, 700, now + 1200)
+    assert slope == pytest.approx(0.5)
+    assert max(result.state for result in results_of(results)) == State.CRIT
+    metrics = metrics_of(results)
+    assert metrics['mssql_log_shipping_gap_time_to_crit'] == pytest.approx(2200)
+    assert metrics['mssql_log_shipping_gap_p95'] == 700
+
+
+def test_gap_trend_short_check_interval():
+    params = dict(PARAMS, trend_window=7200)
+    store = {}
+    now = int(time.time())
+    for minute in range(30):
+        slope, _results = mssql_log_shipping._gap_trend(params, store, 100 + 10 * minute, now + 60 * minute)
+    assert slope == pytest.approx(10 / 60)
+    samples = mssql_log_shipping.RingBuffer(mssql_log_shipping.GAP_SAMPLES, store['gap_samples']).samples()
+    assert len(samples) == 15
+    assert samples[-1] == (now + 60 * 29, 390)
+
+
+@pytest.mark.parametrize('ignore_shrinking, state', [
+    (False, State.WARN),
+    (True, State.OK),
+])
+def test_gap_ignore_shrinking(ignore_shrinking, state):
+    section = parse({'primary': primary_host('MYDB', backup_age=300), 'secondary': secondary_host('MYDB', restore_age=1300)})
+    pair, database = section.items['MYDB']
+    now = time.time()
+    history = mssql_log_shipping.RingBuffer(mssql_log_shipping.GAP_SAMPLES)
+    history.append(now - 1200, 1600)
+    history.append(now - 600, 1300)
+    store = {'gap_samples': history.dump()}
+
+    params = dict(PARAMS, gap_ignore_shrinking=ignore_shrinking)
+    gap_result = next(result for result in results_of(mssql_log_shipping._check_pair(database, params, pair, store)) if result.details.startswith('Gap'))
+    assert gap_result.state == state
+    assert gap_result.details.endswith('(shrinking)') == ignore_shrinking
+
+
+def test_parse_cache():
+    cache = mssql_log_shipping.ParseCache(2)
+    calls = []
+
+    def parse_table(string_table):
+        calls.append(string_table)
+        return len(calls)
+
+    assert cache.get([['a']], parse_table) == 1
+    assert cache.get([['a']], parse_table) == 1
+    cache.get([['b']], parse_table)
+    cache.get([['c']], parse_table)
+    assert cache.get([['a']], parse_table) == 4
+    assert (cache.hits, cache.misses) == (1, 4)
+
+    assert cache.lookup('missing', lambda: None) is None
+    assert cache.lookup('missing', lambda: 5) == 5
+    assert cache.lookup('missing', lambda: 6) == 5
+
+
+def test_apply_delta():
+    data = {'a': 1, 'b': [1, 2], 'c': 3, 'e': {'f': 1}}
+    delta = {'d': {'a': {'=': 5}, 'b': {'l': {'1': {'=': 9}}}, 'e': {'d': {'g': {'=': 2}}}}, 'r': ['c']}
+    assert mssql_log_shipping._apply_delta(data, delta) == {'a': 5, 'b': [1, 9], 'e': {'f': 1, 'g': 2}}
+    assert data == {'a': 1, 'b': [1, 2], 'c': 3, 'e': {'f': 1}}
+
+
+def test_keyframe_and_delta(keyframes):
+    data = {'primary': primary_host('MYDB'), 'secondary': secondary_host('MYDB')}
+    section = mssql_log_shipping._parse_section([['k', 'abc123']] + encode(data))
+    assert list(section.items) == ['MYDB']
+    assert json.loads((keyframes / 'abc123.json').read_text()) == data
+
+    mssql_log_shipping.KEYFRAMES.clear()
+    delta = {'d': {'secondary': {'d': {'status': {'l': {'0': {'d': {'last_restored_file': {'=': 'NEW.trn'}}}}}}}}}
+    section = mssql_log_shipping._parse_section([['d', 'abc123', '0']] + encode(delta))
+    pair, database = section.items['MYDB']
+    assert pair.secondary.status[database].last_restored_file == 'NEW.trn'
+    assert pair.primary.status[database].last_backup_file == 'MYDB.trn'
+
+
+def test_delta_without_keyframe(keyframes):
+    assert mssql_log_shipping._parse_section([['d', 'unknown', '0']] + encode({'d': {}})) is None
+
+
+def test_store_keyframe_unsafe_id(keyframes):
+    mssql_log_shipping._store_keyframe('../abc', {'a': 1})
+    assert os.listdir(keyframes) == []
+    assert mssql_log_shipping._read_keyframe('../abc') is None
+
+
+def test_summary_counts_shipped_databases():
+    section = parse({'pairs': [
+        {'name': 'sql01/sql02', 'primary': primary_host('A', 'B', 'C', 'D'), 'secondary': secondary_host('A', 'B', 'C')},
+        {'name': 'sql01/sql03', 'primary': primary_host('A', 'B', 'C', 'D'), 'secondary': {'error': 'Login failed'}},
+    ]})
+    assert list(mssql_log_shipping.discover_mssql_log_shipping_summary(section)) == [Service()]
+
+    results = list(mssql_log_shipping.check_mssql_log_shipping_summary(SUMMARY_PARAMS, section))
+    assert results[0] == Result(state=State.OK, summary='Databases: 3 (3 OK, 0 WARN, 0 CRIT)')
+    metrics = metrics_of(results)
+    assert metrics['mssql_log_shipping_summary_ok_databases'] == 3
+    assert metrics['mssql_log_shipping_summary_crit_databases'] == 0
+    assert metrics['mssql_log_shipping_summary_failed_pairs'] == 1
+    assert any(result.state == State.CRIT and result.summary.startswith('Failed Pairs (of 2)') for result in results_of(results))
+    assert Result(state=State.OK, notice='sql01/sql03: Secondary unreachable: Login failed') in results
+
+
+def test_summary_classifies_databases():
+    section = parse({'pairs': [
+        {'name': 'sql01/sql02', 'primary': primary_host('A', backup_age=300), 'secondary': secondary_host('A', restore_age=1300)},
+        {'name': 'sql01/sql03', 'primary': primary_host('B', backup_age=300), 'secondary': secondary_host('B', restore_age=8000)},
+    ]})
+    params = dict(SUMMARY_PARAMS, time_since_last_restore_p50_upper=(1200, 7200))
+    results = list(mssql_log_shipping.check_mssql_log_shipping_summary(params, section))
+    assert results[0] == Result(state=State.OK, summary='Databases: 2 (0 OK, 1 WARN, 1 CRIT)')
+    p50 = next(result for result in results_of(results) if result.details.startswith('Time Since Last Restore 50th Percentile'))
+    assert p50.state == State.WARN
+
+
+def test_summary_without_shipped_databases():
+    section = parse({'primary': primary_host('A'), 'secondary': secondary_host('B')})
+    assert list(mssql_log_shipping.discover_mssql_log_shipping_summary(section)) == []
+
+
+def test_check_unreachable(value_store):
+    section = parse({'primary': primary_host('MYDB', backup_age=5000), 'secondary': {'error': 'Login failed'}})
+    results = list(mssql_log_shipping.check_mssql_log_shipping_plugin('MYDB', PARAMS, section))
+    assert Result(state=State.CRIT, summary='Secondary unreachable: Login failed') in results
+    assert any(result.state == State.WARN for result in results_of(results))
+    assert metrics_of(results)['mssql_log_shipping_time_since_last_backup'] == pytest.approx(5000, abs=5)
+
+
+@pytest.mark.parametrize('params, state', [
+    (PARAMS, State.WARN),
+    (dict(PARAMS, circuit_open_state=0), State.OK),
+])
+def test_check_circuits(value_store, params, state):
+    now = time.time()
+    primary = dict(primary_host('MYDB'), circuit={'failures': 3, 'error': 'Login failed', 'probe_at': now + 60, 'good_at': now - 120})
+    section = parse({'primary': primary, 'secondary': secondary_host('MYDB')})
+    pair, _database = section.items['MYDB']
+    results = list(mssql_log_shipping._check_circuits(params, pair))
+    assert len(results) == 1
+    assert results[0].state == state
+    assert results[0].summary.startswith('Primary circuit open')
+    assert 'Login failed' in results[0].details
+
+
+def test_check_circuits_skips_unreachable():
+    section = parse({'primary': {'error': 'Login failed', 'circuit': {'failures': 3, 'error': 'Login failed', 'probe_at': 0, 'good_at': 0}}, 'secondary': secondary_host('MYDB')})
+    assert list(mssql_log_shipping._check_circuits(PARAMS, section.pairs[0])) == []
+
+
+def test_discovery_by_topology(value_store):
+    section = parse({
+        'primary': primary_host('MYDB', 'SALES'),
+        'secondary': secondary_host('MYDB_DR', 'OTHERDB', restore_age=600),
+        'links': [
+            {'primary_database': 'MYDB', 'secondary_database': 'MYDB_DR', 'restore_threshold': 300},
+            {'primary_database': 'MISSING', 'secondary_database': 'OTHERDB', 'restore_threshold': None},
+        ],
+    })
+    assert list(mssql_log_shipping.discover_mssql_log_shipping_plugin(section)) == [Service(item='MYDB_DR')]
+
+    results = list(mssql_log_shipping.check_mssql_log_shipping_plugin('MYDB_DR', PARAMS, section))
+    assert results[-1] == Result(state=State.OK, summary='Synchronized databases', details='\nLast Backup File: MYDB.trn\nLast Copied File: MYDB_DR.trn\nLast Restored File: MYDB_DR.trn')
+
+    results = list(mssql_log_shipping.check_mssql_log_shipping_plugin('MYDB_DR', dict(PARAMS, use_restore_threshold=True), section))
+    assert results[-1].summary == 'Desynchronized databases'
@@ -3,7 +3,17 @@
 # Checkmk special agent for MSSQL Log Shipping (https://github.com/Fyotta/checkmk-mssql-log-shipping) - Francisco Fernandes <franciscoyotta@gmail.com>
 # This code is distributed under the terms of the GNU General Public License, version 3 (GPLv3).
 # See the LICENSE file for details on the license terms.
+import argparse
+import base64
 import datetime
+import io
+import json
+import os
+import socket
+import threading
+import time
+import zlib
+from decimal import Decimal
 from unittest.mock import MagicMock
 from uuid import UUID
 import pytest
@@ -15,6 +25,178 @@ spec = spec_from_loader('agent_mssql_log_shipping', SourceFileLoader('agent_mssq
 agent_mssql_log_shipping = module_from_spec(spec)
 spec.loader.exec_module(agent_mssql_log_shipping)
 
+spec = spec_from_loader('fake_mssql_driver', SourceFileLoader('fake_mssql_driver', 'src/tests/benchmark/fake_mssql_driver.py'))
+fake_mssql_driver = module_from_spec(spec)
+spec.loader.exec_module(fake_mssql_driver)
+
+PRIMARY_STATUS_ROWS = [
+    (b'MSSQLSERVER', 'MYDB', 'C:\\MYDBLOG\\MYDB_20240226133001.trn', datetime.datetime(2024, 2, 26, 10, 30, 1, 340000), datetime.datetime(2024, 2, 26, 13, 30, 1, 340000)),
+]
+SECONDARY_STATUS_ROWS = [
+    (b'MSSQLSERVER', 'MYDB', 'C:\\log_shipping\\MYDB_20240226133001.trn', datetime.datetime(2024, 2, 26, 10, 30, 1, 390000), datetime.datetime(2024, 2, 26, 13, 30, 1, 390000), 'C:\\log_shipping\\MYDB_20240226130000.trn', datetime.datetime(2024, 2, 26, 10, 15, 1, 313000), datetime.datetime(2024, 2, 26, 13, 30, 1, 390000)),
+]
+JOBS_ROWS = [
+    (UUID('7ee36c8b-e64d-4f00-8c06-0d493631c890'), 'LSBackup_MYDB', 1, 20240226, 103000, 1, 'The job succeeded.', 20240226, 103000, 1, 1),
+    (UUID('42f5572f-23b5-4e20-8459-63b3d3428f74'), 'syspolicy_purge_history', 1, 20240227, 20000, 1, 'The job succeeded.', 20240226, 20000, 2, 1),
+]
+PRIMARY_JOBS_ROWS = [
+    (UUID('7ee36c8b-e64d-4f00-8c06-0d493631c890'), 'LSBackup_MYDB', 1, 20240226, 103000, 1, 'The job succeeded.', 20240226, 103000, 1, 1, 'MYDB', 'backup'),
+]
+SECONDARY_JOBS_ROWS = [
+    (UUID('b5640351-801f-41aa-901e-39178c094a5d'), 'LSCopy_NOCMSSQLREP03_MYDB', 1, 20240226, 104500, 1, 'The job succeeded.', 20240226, 103000, 1, 1, 'MYDB', 'copy'),
+    (UUID('909fe951-e1f8-45e1-bc30-17e6f0a25f4d'), 'LSRestore_NOCMSSQLREP03_MYDB', 1, 20240226, 104500, 1, 'The job succeeded.', 20240226, 103000, 0, 1, 'MYDB', 'restore'),
+]
+PRIMARY_STATUS_AGES_ROWS = [row + (840,) for row in PRIMARY_STATUS_ROWS]
+SECONDARY_STATUS_AGES_ROWS = [row + (839, 839) for row in SECONDARY_STATUS_ROWS]
+TIME_ROWS = [
+    (datetime.datetime(2024, 2, 26, 10, 44, 14, 500000),),
+]
+HISTORY_ROWS = [
+    ('MYDB', 1, 101, 2, datetime.datetime(2024, 2, 26, 13, 15, 0, 120000)),
+    ('MYDB', 2, 102, 3, datetime.datetime(2024, 2, 26, 13, 15, 2, 500000)),
+    ('OTHERDB', 1, 55, 3, datetime.datetime(2024, 2, 26, 13, 16, 0)),
+    ('MYDB', 2, 103, 2, datetime.datetime(2024, 2, 26, 13, 30, 1, 390000)),
+]
+LOG_BACKUP_ROWS = [
+    (7001, 'MYDB', Decimal('41000000012800001'), Decimal('41000000013600001'), Decimal('1048576'), datetime.datetime(2024, 2, 26, 13, 0, 1)),
+    (7002, 'MYDB', Decimal('41000000013600001'), Decimal('41000000014400001'), Decimal('4194304'), datetime.datetime(2024, 2, 26, 13, 15, 1)),
+    (7003, 'MYDB', Decimal('41000000014400001'), Decimal('41000000015200001'), Decimal('8388608'), datetime.datetime(2024, 2, 26, 13, 30, 1)),
+]
+RESTORE_ROWS = [
+    (301, 'MYDB', Decimal('41000000011200001'), Decimal('41000000012800001'), Decimal('2097152'), datetime.datetime(2024, 2, 26, 13, 0, 0)),
+    (302, 'MYDB', Decimal('41000000012800001'), Decimal('41000000013600001'), Decimal('1048576'), datetime.datetime(2024, 2, 26, 13, 1, 0)),
+]
+PRIMARY_TOPOLOGY_ROWS = [
+    ('SQL01', 'MYDB', 'SQL02', 'MYDB_DR'),
+    ('SQL01', 'MYDB', 'SQL03', 'MYDB'),
+]
+SECONDARY_TOPOLOGY_ROWS = [
+    ('SQL02', 'MYDB_DR', 'SQL01', 'MYDB', 45, 1),
+    ('SQL02', 'SALES', 'sql01', 'SALES', 60, 0),
+    ('SQL02', 'OTHERDB', 'SQL09', 'OTHERDB', 45, 1),
+]
+ERROR_ROWS = [
+    ('MYDB', 2, 102, datetime.datetime(2024, 2, 26, 13, 15, 2, 500000), 'Could not apply log backup file'),
+    ('OTHERDB', 1, 55, datetime.datetime(2024, 2, 26, 13, 16, 0), 'The network path was not found'),
+]
+
+
+class FakeMssql:
+    """Stand-in for Mssql answering the QUERY statements with canned rows"""
+    connections = []
+    failing_hosts = set()
+    delays = {}
+
+    def __init__(self, host, db_name, user, pwd, port=1433, timeout=0, timeout_connection=60):
+        self.address = (host, port)
+        self.queries = []
+        self.timeouts = []
+        self.connected = False
+
+    def connect(self):
+        time.sleep(self.delays.get(self.address[0], 0))
+        if self.address[0] in self.failing_hosts:
+            raise Exception(f"Unable to connect: {self.address[0]}")
+        FakeMssql.connections.append(self)
+        self.connected = True
+
+    def disconnect(self):
+        self.connected = False
+
+    def ping(self):
+        return self.connected and self.address[0] not in self.failing_hosts
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.disconnect()
+
+    def set_timeout(self, timeout):
+        self.timeouts.append(timeout)
+
+    def execute(self, query):
+        self.queries.append(query)
+        if 'log_shipping_monitor_history_detail' in query:
+            return HISTORY_ROWS
+        if 'log_shipping_monitor_error_detail' in query:
+            return ERROR_ROWS
+        if 'log_shipping_primary_secondaries' in query:
+            return PRIMARY_TOPOLOGY_ROWS
+        if 'primary_server' in query:
+            return SECONDARY_TOPOLOGY_ROWS
+        if 'from backupset' in query:
+            return [] if 'bs.backup_set_id >' in query else LOG_BACKUP_ROWS
+        if 'from restorehistory' in query:
+            return [] if 'rh.restore_history_id >' in query else RESTORE_ROWS
+        rows = {
+            agent_mssql_log_shipping.QUERY['get_primary_status']['query']: PRIMARY_STATUS_ROWS,
+            agent_mssql_log_shipping.QUERY['get_secondary_status']['query']: SECONDARY_STATUS_ROWS,
+            agent_mssql_log_shipping.QUERY['get_primary_status_ages']['query']: PRIMARY_STATUS_AGES_ROWS,
+            agent_mssql_log_shipping.QUERY['get_secondary_status_ages']['query']: SECONDARY_STATUS_AGES_ROWS,
+            agent_mssql_log_shipping.QUERY['get_jobs']['query']: JOBS_ROWS,
+            agent_mssql_log_shipping.QUERY['get_primary_jobs']['query']: PRIMARY_JOBS_ROWS,
+            agent_mssql_log_shipping.QUERY['get_secondary_jobs']['query']: SECONDARY_JOBS_ROWS,
+            agent_mssql_log_shipping.QUERY['get_server_current_time']['query']: TIME_ROWS,
+        }
+        return rows[query]
+
+    def execute_batch(self, queries):
+        self.batches = getattr(self, 'batches', 0) + 1
+        return [self.execute(query) for query in queries]
+
+
+@pytest.fixture
+def fake_mssql():
+    FakeMssql.connections = []
+    FakeMssql.failing_hosts = set()
+    FakeMssql.delays = {}
+    return FakeMssql
+
+
+def decode_columnar(data, strings):
+    if isinstance(data, dict) and '#' in data:
+        columns = [
+            [None if value is None else strings[value] for value in values] if kind == 's' else
+            [None if value is None else (agent_mssql_log_shipping.EPOCH + datetime.timedelta(microseconds=value)).isoformat() for value in values] if kind == 't' else
+            values
+            for kind, values in zip(data['k'], data['v'])
+        ]
+        return [dict(zip(data['#'], row)) for row in zip(*columns)]
+    if isinstance(data, dict):
+        return {key: decode_columnar(value, strings) for key, value in data.items()}
+    if isinstance(data, list):
+        return [decode_columnar(value, strings) for value in data]
+    return data
+
+
+def split_sections(output):
+    sections = {}
+    for line in output.splitlines():
+        if line.startswith('<<<<'):
+            continue
+        if line.startswith('<<<'):
+            name = line.strip('<>').split(':')[0]
+            sections[name] = []
+        else:
+            sections[name].append(line)
+    return sections
+
+
+def decode_section(output):
+    assert output.startswith('<<<mssql_log_shipping>>>\n') or output.startswith('<<<mssql_log_shipping:cached(')
+    return decode_payload(split_sections(output)['mssql_log_shipping'])
+
+
+def decode_payload(lines):
+    payload = '\n'.join(lines)
+    if payload.startswith('2\n'):
+        data = json.loads(zlib.decompress(base64.b64decode(payload[2:])))
+        assert data['v'] == 2
+        return decode_columnar(data['d'], data['s'])
+    return json.loads(zlib.decompress(base64.b64decode(payload)))
+
 
 class TestAPI:
     @pytest.mark.parametrize(
@@ -86,6 +268,57 @@ class TestAPI:
             assert parsed_args.login_timeout == expected_result['login_timeout']
             assert parsed_args.primary == expected_result['primary']
             assert parsed_args.secondary == expected_result['secondary']
+            assert parsed_args.multi_pair is False
+            assert parsed_args.pairs == [(expected_result['primary'], expected_result['secondary'])]
+
+    @pytest.mark.parametrize(
+        'args, expected_pairs, expected_exception',
+        [
+            (
+                ['-u', 'db_user', '-p', 'mypass123', '--pair', 'sql01', 'sql02:1434', '--pair', 'sql01', 'sql03'],
+                [(('sql01', 1433), ('sql02', 1434)), (('sql01', 1433), ('sql03', 1433))],
+                None
+            ),
+            (
+                ['-u', 'db_user', '-p', 'mypass123', '--pair', 'sql01', 'sql03', 'sql01', 'sql02'],
+                [(('sql01', 1433), ('sql02', 1433)), (('sql01', 1433), ('sql03', 1433))],
+                None
+            ),
+            (
+                ['-u', 'db_user', '-p', 'mypass123'],
+                None,
+                SystemExit
+            ),
+            (
+                ['-u', 'db_user', '-p', 'mypass123', 'sql01'],
+                None,
+                SystemExit
+            ),
+            (
+                ['-u', 'db_user', '-p', 'mypass123', '--pair', 'sql01', 'sql02:99999'],
+                None,
+                SystemExit
+            ),
+        ]
+    )
+    def test_parse_pairs(self, args, expected_pairs, expected_exception):
+        if expected_exception is not None:
+            with pytest.raises(expected_exception):
+                agent_mssql_log_shipping.parse_arguments(args)
+        else:
+            parsed_args = agent_mssql_log_shipping.parse_arguments(args)
+            assert parsed_args.multi_pair is True
+            assert parsed_args.pairs == expected_pairs
+
+    def test_parse_pairs_file(self, tmp_path):
+        pairs_file = tmp_path / 'pairs.txt'
+        pairs_file.write_text('# primary secondary\nsql01 sql02\n\nsql01:1434 sql03  # dr site\n')
+        parsed_args = agent_mssql_log_shipping.parse_arguments(['-u', 'db_user', '-p', 'mypass123', '--pairs-file', str(pairs_file)])
+        assert parsed_args.pairs == [(('sql01', 1433), ('sql02', 1433)), (('sql01', 1434), ('sql03', 1433))]
+
+        pairs_file.write_text('sql01 sql02 sql03\n')
+        with pytest.raises(SystemExit):
+            agent_mssql_log_shipping.parse_arguments(['-u', 'db_user', '-p', 'mypass123', '--pairs-file', str(pairs_file)])
 
 
 class TestCore:
@@ -98,8 +331,19 @@ class TestCore:
         ]
         return mssql_mock
 
-    def test_querying(self, mock_mssql):
-        args_namespace = MagicMock()
+    @pytest.fixture
+    def args_namespace(self, tmp_path):
+        return argparse.Namespace(
+            user='db_user', password='mypass123', timeout=0, login_timeout=60, pair_timeout=0, workers=4, batch=False, all_jobs=False,
+            cache=False, cache_ttls={}, state_dir=str(tmp_path), run_timeout=0, section_format=1,
+            piggyback=None, piggyback_hosts={}, history=False, lsn_lag=False, topology=False, server_ages=False,
+            dns_cache=False, dns_ttl=300, connect_stagger=500, delta=False, keyframe_interval=3600, keyframe_dir=str(tmp_path / 'keyframes'),
+            circuit_breaker=False, circuit_failures=3, circuit_backoff=60, record=None, export=None, export_format='openmetrics',
+            primary=('localhost', 1234), secondary=('localhost', 5678), multi_pair=False,
+            pairs=[(('localhost', 1234), ('localhost', 5678))],
+        )
+
+    def test_querying(self, mock_mssql, args_namespace):
         result_info = agent_mssql_log_shipping.querying(args_namespace, agent_mssql_log_shipping.DbType.PRIMARY, mock_mssql)
         result_jobs = agent_mssql_log_shipping.querying(args_namespace, agent_mssql_log_shipping.DbType.SECONDARY, mock_mssql)
         assert result_info, result_jobs == ([(1, 'Status 1'), (2, 'Status 2')], [(3, 'Status 3'), (4, 'Status 4')])
@@ -253,3 +497,700 @@ class TestCore:
     def test_result_to_dict(self, raw_query_results, expected_result, columns, cast):
         data = cast(columns, raw_query_results)
         assert data == expected_result
+
+    def test_get_log_shipping_section(self, fake_mssql, args_namespace):
+        section = decode_section(agent_mssql_log_shipping.get_log_shipping_section(args_namespace, fake_mssql))
+        assert set(section) == {'primary', 'secondary'}
+        assert section['primary']['status'][0]['primary_database'] == 'MYDB'
+        assert section['secondary']['status'][0]['secondary_database'] == 'MYDB'
+        assert section['primary']['server_current_time'] == {'server_current_time': '2024-02-26T10:44:14.500000'}
+
+    def test_get_log_shipping_section_multi_pair(self, fake_mssql):
+        args = agent_mssql_log_shipping.parse_arguments([
+            '-u', 'db_user', '-p', 'mypass123', '--workers', '2',
+            '--pair', 'sql01', 'sql02', '--pair', 'sql01', 'sql03:1434', '--pair', 'sql04', 'sql02',
+        ])
+        fake_mssql.failing_hosts = {'sql04'}
+        section = decode_section(agent_mssql_log_shipping.get_log_shipping_section(args, fake_mssql))
+
+        assert sorted(db.address for db in fake_mssql.connections) == [('sql01', 1433), ('sql02', 1433), ('sql03', 1434)]
+        sql01 = next(db for db in fake_mssql.connections if db.address == ('sql01', 1433))
+        assert len(sql01.queries) == 3
+        assert [pair['name'] for pair in section['pairs']] == ['sql01/sql02', 'sql01/sql03:1434', 'sql04/sql02']
+        assert section['pairs'][0]['primary'] == section['pairs'][1]['primary']
+        assert section['pairs'][2]['primary'] == {'error': 'Unable to connect: sql04'}
+        assert section['pairs'][2]['secondary'] == section['pairs'][0]['secondary']
+
+    def test_get_log_shipping_section_failing_hosts(self, fake_mssql):
+        arguments = ['-u', 'db_user', '-p', 'mypass123', '--workers', '2']
+        for index in range(6):
+            arguments += ['--pair', f"sql{index}a", f"sql{index}b"]
+        args = agent_mssql_log_shipping.parse_arguments(arguments)
+        fake_mssql.failing_hosts = {host for pair in args.pairs for host, _port in pair}
+        output = []
+        thread = threading.Thread(target=lambda: output.append(agent_mssql_log_shipping.get_log_shipping_section(args, fake_mssql)), daemon=True)
+        thread.start()
+        thread.join(timeout=5)
+        assert not thread.is_alive()
+        section = decode_section(output[0])
+        assert [pair['primary'] for pair in section['pairs']] == [{'error': f"Unable to connect: sql{index}a"} for index in range(6)]
+
+    def test_get_log_shipping_section_partial(self, fake_mssql, args_namespace):
+        fake_mssql.failing_hosts = {'localhost'}
+        with pytest.raises(Exception, match='Unable to connect: localhost'):
+            agent_mssql_log_shipping.get_log_shipping_section(args_namespace, fake_mssql)
+
+        args_namespace.primary, args_namespace.secondary = ('sql01', 1433), ('sql02', 1433)
+        args_namespace.pairs = [(args_namespace.primary, args_namespace.secondary)]
+        fake_mssql.failing_hosts = {'sql02'}
+        section = decode_section(agent_mssql_log_shipping.get_log_shipping_section(args_namespace, fake_mssql))
+        assert section['primary']['status'][0]['primary_database'] == 'MYDB'
+        assert section['secondary'] == {'error': 'Unable to connect: sql02'}
+
+    def test_run_timeout(self, fake_mssql, args_namespace):
+        args_namespace.run_timeout = 1
+        args_namespace.primary, args_namespace.secondary = ('sql01', 1433), ('sql02', 1433)
+        args_namespace.pairs = [(args_namespace.primary, args_namespace.secondary)]
+        fake_mssql.delays = {'sql02': 2}
+        start = time.time()
+        section = decode_section(agent_mssql_log_shipping.get_log_shipping_section(args_namespace, fake_mssql))
+        assert time.time() - start < 1.5
+        assert section['primary']['status'][0]['primary_database'] == 'MYDB'
+        assert section['secondary'] == {'error': 'not completed within the run timeout'}
+        assert all(thread.daemon for thread in threading.enumerate() if thread.name.startswith('agent_mssql_log_shipping_worker'))
+
+    def test_daemon_executor(self):
+        executor = agent_mssql_log_shipping.DaemonExecutor(1)
+        release = threading.Event()
+        running = executor.submit(release.wait)
+        pending = executor.submit(time.time)
+        agent_mssql_log_shipping.concurrent.futures.wait([running], timeout=0.2)
+        executor.shutdown()
+        assert pending.cancelled()
+        release.set()
+        assert running.result(timeout=1) is True
+
+    def test_daemon_executor_idle_workers(self):
+        executor = agent_mssql_log_shipping.DaemonExecutor(2)
+        tasks = [executor.submit(time.time) for _index in range(2)]
+        agent_mssql_log_shipping.concurrent.futures.wait(tasks, timeout=1)
+        time.sleep(0.1)
+        tasks += [executor.submit(time.time) for _index in range(4)]
+        _done, not_done = agent_mssql_log_shipping.concurrent.futures.wait(tasks, timeout=1)
+        executor.shutdown()
+        assert not not_done
+
+    def test_section_format(self, fake_mssql, args_namespace):
+        expected = decode_section(agent_mssql_log_shipping.get_log_shipping_section(args_namespace, fake_mssql))
+        args_namespace.section_format = 2
+        output = agent_mssql_log_shipping.get_log_shipping_section(args_namespace, fake_mssql)
+        assert decode_section(output) == expected
+
+        data = json.loads(zlib.decompress(base64.b64decode(''.join(split_sections(output)['mssql_log_shipping'][1:]))))
+        primary_status = data['d']['primary']['status']
+        assert primary_status['#'] == ['instance_name', 'primary_database', 'last_backup_file', 'last_backup_date', 'last_backup_date_utc']
+        assert primary_status['k'] == 'ssstt'
+        assert primary_status['v'][4] == [1708954201340000]
+        assert data['s'][:2] == ['MSSQLSERVER', 'MYDB']
+
+    def test_columnar_encoder(self):
+        data = {
+            'pairs': [
+                {'name': 'sql01/sql02', 'primary': {'error': 'timeout'}, 'secondary': {'status': [], 'jobs': [{'name': 'a', 'enabled': 1}, {'name': 'a', 'enabled': None}]}},
+            ]
+        }
+        encoded = agent_mssql_log_shipping.ColumnarEncoder().encode(data)
+        assert encoded['d']['pairs'][0]['secondary']['jobs'] == {'#': ['name', 'enabled'], 'k': 'sn', 'v': [[0, 0], [1, None]]}
+        assert decode_columnar(encoded['d'], encoded['s']) == data
+
+    def test_columnar_encoder_result_rows(self):
+        columns = agent_mssql_log_shipping.QUERY['get_secondary_jobs']['columns']
+        data = {'jobs': agent_mssql_log_shipping.iter_results(columns, SECONDARY_JOBS_ROWS), 'status': agent_mssql_log_shipping.iter_results(columns, [])}
+        encoder = agent_mssql_log_shipping.ColumnarEncoder()
+        chunks = list(encoder.iter_json(data))
+        encoded = json.loads(''.join(chunks))
+        assert decode_columnar(encoded['d'], encoded['s']) == {'jobs': agent_mssql_log_shipping.map_many_results(columns, SECONDARY_JOBS_ROWS), 'status': []}
+        assert len(chunks) > len(columns)
+
+    @pytest.mark.parametrize('section_format', [1, 2])
+    def test_iter_section_lines(self, section_format):
+        jobs = [{'name': f"LSCopy_{index}", 'last_outcome_message': 'The job succeeded. ' * (index % 7), 'enabled': index % 2} for index in range(500)]
+        data = {'pairs': [{'name': 'sql01/sql02', 'primary': {'error': 'timeout'}, 'secondary': {'status': [], 'jobs': iter(jobs)}}]}
+        sizes = {}
+        lines = list(agent_mssql_log_shipping.iter_section_lines(data, section_format, sizes))
+        assert decode_payload(lines) == dict(data, pairs=[dict(data['pairs'][0], secondary={'status': [], 'jobs': jobs})])
+        encoded = lines[1:] if section_format == 2 else lines
+        assert len(encoded) > 1 and {len(line) for line in encoded[:-1]} == {76}
+        assert sizes['encoded_bytes'] == sum(len(line) for line in encoded)
+        assert 0 < sizes['compressed_bytes'] < sizes['raw_bytes']
+
+    def test_write_log_shipping_section(self, fake_mssql, args_namespace):
+        stream = io.StringIO()
+        agent_mssql_log_shipping.write_log_shipping_section(args_namespace, stream, fake_mssql)
+        assert stream.getvalue().endswith('\n')
+        assert decode_section(stream.getvalue()) == decode_section(agent_mssql_log_shipping.get_log_shipping_section(args_namespace, fake_mssql))
+
+    def test_agent_section(self, fake_mssql, args_namespace):
+        args_namespace.primary, args_namespace.secondary = ('sql01', 1433), ('sql02', 1433)
+        args_namespace.pairs = [(args_namespace.primary, args_namespace.secondary)]
+        fake_mssql.failing_hosts = {'sql02'}
+        output = agent_mssql_log_shipping.get_log_shipping_section(args_namespace, fake_mssql)
+        assert '\n<<<mssql_log_shipping_agent:sep(0)>>>\n' in output
+        agent_section = json.loads(split_sections(output)['mssql_log_shipping_agent'][0])
+        assert agent_section['encoded_bytes'] == sum(len(line) for line in split_sections(output)['mssql_log_shipping'])
+        assert 0 < agent_section['compressed_bytes'] < agent_section['raw_bytes']
+        assert agent_section['run_time'] >= 0
+        assert agent_section['hosts']['sql02'] == {'error': 'Unable to connect: sql02'}
+        sql01 = agent_section['hosts']['sql01']
+        assert sql01['connect_time'] >= 0 and sql01['total_time'] >= sql01['connect_time']
+        assert {name: timing['rows'] for name, timing in sql01['queries'].items()} == {'get_primary_status': 1, 'get_primary_jobs': 1, 'get_server_current_time': 1}
+        assert sql01['cached'] == []
+
+        args_namespace.batch = True
+        output = agent_mssql_log_shipping.get_log_shipping_section(args_namespace, fake_mssql)
+        sql01 = json.loads(split_sections(output)['mssql_log_shipping_agent'][0])['hosts']['sql01']
+        assert sql01['batch_time'] >= 0
+        assert 'time' not in sql01['queries']['get_primary_status']
+
+    def test_piggyback(self, fake_mssql):
+        args = agent_mssql_log_shipping.parse_arguments([
+            '-u', 'db_user', '-p', 'mypass123', '--piggyback', 'secondary', '--piggyback-host', 'sql03:1434=dr-sql03', '--piggyback-host', 'sql02=SQL02.example.com',
+            '--pair', 'sql01', 'sql02', '--pair', 'sql01', 'sql03:1434', '--pair', 'sql04', 'sql02',
+        ])
+        output = agent_mssql_log_shipping.get_log_shipping_section(args, fake_mssql)
+        lines = output.splitlines()
+        assert [line for line in lines if line.startswith('<<<<')] == ['<<<<SQL02.example.com>>>>', '<<<<dr-sql03>>>>', '<<<<>>>>']
+        assert lines[lines.index('<<<<>>>>') + 1] == '<<<mssql_log_shipping_agent:sep(0)>>>'
+        sql02 = decode_payload(lines[lines.index('<<<<SQL02.example.com>>>>') + 2:lines.index('<<<<dr-sql03>>>>')])
+        assert [pair['name'] for pair in sql02['pairs']] == ['sql01/sql02', 'sql04/sql02']
+        sql03 = decode_payload(lines[lines.index('<<<<dr-sql03>>>>') + 2:lines.index('<<<<>>>>')])
+        assert [pair['name'] for pair in sql03['pairs']] == ['sql01/sql03:1434']
+
+        args.piggyback = 'both'
+        output = agent_mssql_log_shipping.get_log_shipping_section(args, fake_mssql)
+        assert [line for line in output.splitlines() if line.startswith('<<<<')] == ['<<<<sql01>>>>', '<<<<SQL02.example.com>>>>', '<<<<dr-sql03>>>>', '<<<<sql04>>>>', '<<<<>>>>']
+
+        with pytest.raises(SystemExit):
+            agent_mssql_log_shipping.parse_arguments(['-u', 'db_user', '-p', 'mypass123', '--piggyback-host', 'sql02', 'sql01', 'sql02'])
+
+    def test_piggyback_host_default_port(self):
+        args = agent_mssql_log_shipping.parse_arguments([
+            '-u', 'db_user', '-p', 'mypass123', '--piggyback', 'both',
+            '--piggyback-host', 'sql01:1433=cmk-sql01', '--piggyback-host', 'sql02,10.0.0.2:1433=cmk-sql02', '--piggyback-host', 'sql03:1434=cmk-sql03',
+            '--pair', 'sql01', 'sql02,10.0.0.2', '--pair', 'sql01:1433', 'sql03:1434',
+        ])
+        assert args.piggyback_hosts == {'sql01': 'cmk-sql01', 'sql02,10.0.0.2': 'cmk-sql02', 'sql03:1434': 'cmk-sql03'}
+        assert [agent_mssql_log_shipping.piggyback_hostname(args, address) for pair in args.pairs for address in pair] == ['cmk-sql01', 'cmk-sql02', 'cmk-sql01', 'cmk-sql03']
+
+    def test_history(self, args_namespace, fake_mssql):
+        args_namespace.history = True
+        args_namespace.section_format = 2
+        data = decode_section(agent_mssql_log_shipping.get_log_shipping_section(args_namespace, fake_mssql))
+        assert 'events' not in data['primary']
+        assert data['secondary']['events'] == [
+            {'database': 'MYDB', 'copy_success': 1, 'copy_failed': 0, 'restore_success': 1, 'restore_failed': 1, 'last_error': 'Restore: Could not apply log backup file', 'last_error_date_utc': '2024-02-26T13:15:02.500000'},
+            {'database': 'OTHERDB', 'copy_success': 0, 'copy_failed': 1, 'restore_success': 0, 'restore_failed': 0, 'last_error': 'Copy: The network path was not found', 'last_error_date_utc': '2024-02-26T13:16:00'},
+        ]
+        secondary = next(db for db in fake_mssql.connections if db.address == ('localhost', 5678))
+        assert 'sysutcdatetime()' in secondary.queries[2] and 'log_time_utc >' in secondary.queries[2]
+        assert not any('history_detail' in query for db in fake_mssql.connections if db.address == ('localhost', 1234) for query in db.queries)
+
+        state = agent_mssql_log_shipping.HostState(str(args_namespace.state_dir))
+        assert state.load(('localhost', 5678))['watermarks'] == {
+            'get_history': ['2024-02-26T13:30:01.390000', 103],
+            'get_errors': ['2024-02-26T13:16:00', 55],
+        }
+        fake_mssql.connections = []
+        agent_mssql_log_shipping.get_log_shipping_section(args_namespace, fake_mssql)
+        secondary = next(db for db in fake_mssql.connections if db.address == ('localhost', 5678))
+        assert "(log_time_utc > '2024-02-26T13:30:01.390' or (log_time_utc = '2024-02-26T13:30:01.390' and session_id > 103))" in secondary.queries[2]
+        assert "(log_time_utc > '2024-02-26T13:16:00.000' or (log_time_utc = '2024-02-26T13:16:00.000' and session_id > 55))" in secondary.queries[3]
+
+    def test_lsn_lag(self, args_namespace, fake_mssql):
+        args_namespace.lsn_lag = True
+        data = decode_section(agent_mssql_log_shipping.get_log_shipping_section(args_namespace, fake_mssql))
+        assert data['lag'] == [{
+            'database': 'MYDB',
+            'last_restored_lsn': 41000000013600001,
+            'pending_backups': 2,
+            'pending_bytes': 4194304 + 8388608,
+            'restore_rate': 1048576 / 60,
+        }]
+        primary = next(db for db in fake_mssql.connections if db.address == ('localhost', 1234))
+        assert "bs.backup_finish_date > dateadd(second, -86400, getdate())" in primary.queries[-2]
+
+        fake_mssql.connections = []
+        assert decode_section(agent_mssql_log_shipping.get_log_shipping_section(args_namespace, fake_mssql))['lag'] == data['lag']
+        primary = next(db for db in fake_mssql.connections if db.address == ('localhost', 1234))
+        secondary = next(db for db in fake_mssql.connections if db.address == ('localhost', 5678))
+        assert 'bs.backup_set_id > 7003' in primary.queries[-2]
+        assert 'rh.restore_history_id > 302' in secondary.queries[-2]
+        state = agent_mssql_log_shipping.HostState(str(args_namespace.state_dir)).load(('localhost', 5678))
+        assert [row['restore_history_id'] for row in state['rows']['get_restores']] == [301, 302]
+
+    def test_topology_links(self):
+        primary = agent_mssql_log_shipping.map_many_results(agent_mssql_log_shipping.QUERY['get_primary_topology']['columns'], PRIMARY_TOPOLOGY_ROWS)
+        secondary = agent_mssql_log_shipping.map_many_results(agent_mssql_log_shipping.QUERY['get_secondary_topology']['columns'], SECONDARY_TOPOLOGY_ROWS)
+        assert agent_mssql_log_shipping.topology_links(primary, secondary) == [
+            {'primary_database': 'MYDB', 'secondary_database': 'MYDB_DR', 'restore_threshold': 2700},
+        ]
+        assert agent_mssql_log_shipping.topology_links([], secondary) == [
+            {'primary_database': 'MYDB', 'secondary_database': 'MYDB_DR', 'restore_threshold': 2700},
+            {'primary_database': 'SALES', 'secondary_database': 'SALES', 'restore_threshold': None},
+            {'primary_database': 'OTHERDB', 'secondary_database': 'OTHERDB', 'restore_threshold': 2700},
+        ]
+
+    def test_topology(self, args_namespace, fake_mssql):
+        args_namespace.topology = True
+        output = agent_mssql_log_shipping.get_log_shipping_section(args_namespace, fake_mssql)
+        assert output.startswith('<<<mssql_log_shipping>>>\n')
+        assert decode_section(output)['links'] == [{'primary_database': 'MYDB', 'secondary_database': 'MYDB_DR', 'restore_threshold': 2700}]
+        assert sum('primary_server' in query for db in fake_mssql.connections for query in db.queries) == 1
+
+        fake_mssql.connections = []
+        output = agent_mssql_log_shipping.get_log_shipping_section(args_namespace, fake_mssql)
+        assert output.startswith('<<<mssql_log_shipping>>>\n')
+        assert decode_section(output)['links'] == [{'primary_database': 'MYDB', 'secondary_database': 'MYDB_DR', 'restore_threshold': 2700}]
+        assert not any('primary_server' in query or 'log_shipping_primary_secondaries' in query for db in fake_mssql.connections for query in db.queries)
+        assert any('sysjobs' in query for db in fake_mssql.connections for query in db.queries)
+
+    def test_update_window(self):
+        rows = [
+            {'database': 'A', 'restore_date_utc': '2024-02-26T10:00:00'},
+            {'database': 'B', 'restore_date_utc': '2024-02-26T11:00:00'},
+            {'database': 'B', 'restore_date_utc': '2024-02-26T12:30:00'},
+        ]
+        new_rows = [{'database': 'B', 'restore_date_utc': '2024-02-26T13:00:00'}]
+        assert agent_mssql_log_shipping.update_window('get_restores', rows, new_rows) == [rows[0], rows[2], new_rows[0]]
+
+    def test_host_timeouts(self, args_namespace):
+        assert agent_mssql_log_shipping.host_timeouts(args_namespace) == (0, 60)
+        assert agent_mssql_log_shipping.host_deadline(args_namespace) is None
+        args_namespace.pair_timeout = 30
+        assert agent_mssql_log_shipping.host_timeouts(args_namespace, agent_mssql_log_shipping.host_deadline(args_namespace)) == (30, 30)
+        assert agent_mssql_log_shipping.host_timeouts(args_namespace, agent_mssql_log_shipping.host_deadline(args_namespace, time.time() + 9.5)) == (10, 10)
+
+    def test_fetch_queries_deadline(self, fake_mssql, args_namespace):
+        db = fake_mssql('sql01', 'msdb', 'db_user', 'mypass123')
+        db.execute = lambda query: time.sleep(0.8) or []
+        with pytest.raises(agent_mssql_log_shipping.RunTimeoutError):
+            agent_mssql_log_shipping.fetch_queries(args_namespace, db, ['get_primary_status', 'get_primary_jobs', 'get_server_current_time'], deadline=time.time() + 1.5)
+        assert db.timeouts == [2, 1]
+
+    def test_get_log_shipping_section_batch(self, fake_mssql, args_namespace):
+        expected = decode_section(agent_mssql_log_shipping.get_log_shipping_section(args_namespace, fake_mssql))
+        fake_mssql.connections = []
+        args_namespace.batch = True
+        assert decode_section(agent_mssql_log_shipping.get_log_shipping_section(args_namespace, fake_mssql)) == expected
+        assert [db.batches for db in fake_mssql.connections] == [1, 1]
+
+    def test_execute_batch(self):
+        db = agent_mssql_log_shipping.Mssql('localhost', 'msdb', 'db_user', 'mypass123')
+        db._cursor = MagicMock()
+        db._cursor.fetchall.side_effect = [[(1,)], [], [(2,), (3,)]]
+        db._cursor.nextset.side_effect = [True, True, None]
+        assert db.execute_batch(['select 1;', 'select 2;', 'select 3;']) == [[(1,)], [], [(2,), (3,)]]
+        db._cursor.execute.assert_called_once_with('select 1;\nselect 2;\nselect 3;')
+
+        db._cursor.fetchall.side_effect = [[(1,)]]
+        db._cursor.nextset.side_effect = [None]
+        with pytest.raises(Exception):
+            db.execute_batch(['select 1;', 'select 2;'])
+        db._cursor = None
+
+    def test_get_log_shipping_section_jobs(self, fake_mssql, args_namespace):
+        section = decode_section(agent_mssql_log_shipping.get_log_shipping_section(args_namespace, fake_mssql))
+        assert [(job['name'], job['database'], job['role']) for job in section['primary']['jobs']] == [('LSBackup_MYDB', 'MYDB', 'backup')]
+        assert [(job['name'], job['database'], job['role']) for job in section['secondary']['jobs']] == [
+            ('LSCopy_NOCMSSQLREP03_MYDB', 'MYDB', 'copy'),
+            ('LSRestore_NOCMSSQLREP03_MYDB', 'MYDB', 'restore'),
+        ]
+
+        args_namespace.all_jobs = True
+        section = decode_section(agent_mssql_log_shipping.get_log_shipping_section(args_namespace, fake_mssql))
+        assert [job['name'] for job in section['primary']['jobs']] == ['LSBackup_MYDB', 'syspolicy_purge_history']
+        assert 'role' not in section['secondary']['jobs'][0]
+
+    @pytest.mark.parametrize('codec, suffix', [(json, 'json'), (agent_mssql_log_shipping.pickle, 'pickle')])
+    def test_state_files(self, tmp_path, codec, suffix):
+        files = agent_mssql_log_shipping.StateFiles(str(tmp_path / 'state'), 'state', 'state', codec)
+        assert files.load('sql01_1433', 'sql01', {'default': True}) == {'default': True}
+        files.save('sql01_1433', {'watermarks': {'get_history': [1, 2]}})
+        assert files.load('sql01_1433', 'sql01', None) == {'watermarks': {'get_history': [1, 2]}}
+        assert os.listdir(tmp_path / 'state') == [f"state_sql01_1433.{suffix}"]
+        (tmp_path / 'state' / f"state_sql01_1433.{suffix}").write_bytes(b'\x80garbage')
+        assert files.load('sql01_1433', 'sql01', {}) == {}
+
+    def test_query_cache(self, fake_mssql, args_namespace, monkeypatch):
+        args_namespace.cache = True
+        now = 1708958654.0
+        monkeypatch.setattr(agent_mssql_log_shipping.time, 'time', lambda: now)
+        first = agent_mssql_log_shipping.get_log_shipping_section(args_namespace, fake_mssql)
+        assert first.startswith('<<<mssql_log_shipping>>>\n')
+        assert len(fake_mssql.connections[0].queries) == 3
+
+        now += 120
+        fake_mssql.connections = []
+        second = agent_mssql_log_shipping.get_log_shipping_section(args_namespace, fake_mssql)
+        assert second.startswith('<<<mssql_log_shipping:cached(1708958654,300)>>>\n')
+        assert [len(db.queries) for db in fake_mssql.connections] == [1, 1]
+        section = decode_section(second)
+        assert section['primary']['jobs'] == decode_section(first)['primary']['jobs']
+        assert section['primary']['server_current_time'] == {'server_current_time': '2024-02-26T10:46:14.500000'}
+
+        now += 300
+        fake_mssql.connections = []
+        refreshed = agent_mssql_log_shipping.get_log_shipping_section(args_namespace, fake_mssql)
+        assert refreshed.startswith('<<<mssql_log_shipping>>>\n')
+        assert [len(db.queries) for db in fake_mssql.connections] == [2, 2]
+
+        now += 300
+        fake_mssql.connections = []
+        args_namespace.cache_ttls = {'get_server_current_time': 60}
+        third = agent_mssql_log_shipping.get_log_shipping_section(args_namespace, fake_mssql)
+        assert third.startswith('<<<mssql_log_shipping>>>\n')
+        assert [len(db.queries) for db in fake_mssql.connections] == [3, 3]
+
+    def test_circuit_breaker(self, fake_mssql, args_namespace, monkeypatch):
+        args_namespace.primary, args_namespace.secondary = ('sql01', 1433), ('sql02', 1433)
+        args_namespace.pairs = [(args_namespace.primary, args_namespace.secondary)]
+        args_namespace.circuit_breaker, args_namespace.circuit_failures = True, 2
+        now = 1708958654.0
+        monkeypatch.setattr(agent_mssql_log_shipping.time, 'time', lambda: now)
+        good = decode_section(agent_mssql_log_shipping.get_log_shipping_section(args_namespace, fake_mssql))
+
+        fake_mssql.failing_hosts = {'sql02'}
+        for _run in range(2):
+            now += 60
+            section = decode_section(agent_mssql_log_shipping.get_log_shipping_section(args_namespace, fake_mssql))
+            assert section['secondary'] == {'error': 'Unable to connect: sql02'}
+
+        now += 30
+        fake_mssql.connections = []
+        output = agent_mssql_log_shipping.get_log_shipping_section(args_namespace, fake_mssql)
+        assert [db.address for db in fake_mssql.connections] == [('sql01', 1433)]
+        secondary = decode_section(output)['secondary']
+        assert secondary['status'] == good['secondary']['status']
+        assert secondary['server_current_time'] == {'server_current_time': '2024-02-26T10:46:44.500000'}
+        assert secondary['circuit'] == {'failures': 2, 'error': 'Unable to connect: sql02', 'probe_at': now + 30, 'good_at': now - 150}
+        assert json.loads(split_sections(output)['mssql_log_shipping_agent'][0])['hosts']['sql02']['circuit'] == secondary['circuit']
+
+        now += 30
+        section = decode_section(agent_mssql_log_shipping.get_log_shipping_section(args_namespace, fake_mssql))
+        assert section['secondary'] == {'error': 'Unable to connect: sql02'}
+        now += 60
+        assert decode_section(agent_mssql_log_shipping.get_log_shipping_section(args_namespace, fake_mssql))['secondary']['circuit']['probe_at'] == now + 60
+
+        fake_mssql.failing_hosts = set()
+        now += 60
+        assert decode_section(agent_mssql_log_shipping.get_log_shipping_section(args_namespace, fake_mssql)) == good
+
+    def test_circuit_breaker_history(self, fake_mssql, args_namespace, monkeypatch):
+        args_namespace.primary, args_namespace.secondary = ('sql01', 1433), ('sql02', 1433)
+        args_namespace.pairs = [(args_namespace.primary, args_namespace.secondary)]
+        args_namespace.circuit_breaker, args_namespace.circuit_failures, args_namespace.history = True, 1, True
+        now = 1708958654.0
+        monkeypatch.setattr(agent_mssql_log_shipping.time, 'time', lambda: now)
+        good = decode_section(agent_mssql_log_shipping.get_log_shipping_section(args_namespace, fake_mssql))
+        assert good['secondary']['events']
+
+        fake_mssql.failing_hosts = {'sql02'}
+        now += 60
+        agent_mssql_log_shipping.get_log_shipping_section(args_namespace, fake_mssql)
+        for _run in range(2):
+            now += 10
+            secondary = decode_section(agent_mssql_log_shipping.get_log_shipping_section(args_namespace, fake_mssql))['secondary']
+            assert secondary['status'] == good['secondary']['status']
+            assert 'circuit' in secondary
+            assert 'events' not in secondary
+
+    def test_circuit_breaker_without_good_data(self, fake_mssql, args_namespace, monkeypatch):
+        args_namespace.primary, args_namespace.secondary = ('sql01', 1433), ('sql02', 1433)
+        args_namespace.pairs = [(args_namespace.primary, args_namespace.secondary)]
+        args_namespace.circuit_breaker = True
+        fake_mssql.failing_hosts = {'sql02'}
+        for _run in range(3):
+            agent_mssql_log_shipping.get_log_shipping_section(args_namespace, fake_mssql)
+        fake_mssql.connections = []
+        output = agent_mssql_log_shipping.get_log_shipping_section(args_namespace, fake_mssql)
+        assert [db.address for db in fake_mssql.connections] == [('sql01', 1433)]
+        secondary = decode_section(output)['secondary']
+        assert secondary['error'].startswith('circuit open after 3 failures, next probe in ')
+        assert secondary['circuit']['good_at'] is None
+        assert json.loads(split_sections(output)['mssql_log_shipping_agent'][0])['hosts']['sql02']['circuit'] == secondary['circuit']
+
+    def test_record_replay(self, fake_mssql, args_namespace, tmp_path):
+        args_namespace.record = str(tmp_path / 'recording.pickle')
+        args_namespace.batch = True
+        expected = decode_section(agent_mssql_log_shipping.get_log_shipping_section(args_namespace, fake_mssql))
+        driver = fake_mssql_driver.FakeDriver.from_recording(args_namespace.record)
+        assert driver.pairs == args_namespace.pairs
+        assert driver.hosts[('localhost', 1234)]['roles'] == ['primary']
+        assert 'batch_time' in driver.hosts[('localhost', 1234)]['timings']
+
+        args_namespace.record = None
+        args_namespace.batch = False
+        assert decode_section(agent_mssql_log_shipping.get_log_shipping_section(args_namespace, driver)) == expected
+        assert (driver.connections, driver.queries) == (2, 6)
+
+    def test_fake_driver_failures(self, args_namespace):
+        driver = fake_mssql_driver.FakeDriver.synthetic(4, 3, databases=2, jobs=3, failing_hosts={'sql0003'}, latency=0.01, jitter=0.005, seed=1)
+        assert driver.pairs == [(('sql0000', 1433), ('sql0002', 1433)), (('sql0001', 1433), ('sql0003', 1433)), (('sql0000', 1433), ('sql0003', 1433))]
+        args_namespace.pairs, args_namespace.multi_pair = driver.pairs, True
+        section = decode_section(agent_mssql_log_shipping.get_log_shipping_section(args_namespace, driver))
+        assert [len(pair['primary']['status']) for pair in section['pairs']] == [2, 2, 2]
+        assert [pair['secondary'].get('error') for pair in section['pairs']] == [None] + ['20009, DB-Lib error message 20009, severity 9: Unable to connect: Adaptive Server is unavailable or does not exist (sql0003)'] * 2
+
+        driver = fake_mssql_driver.FakeDriver.synthetic(2, 1, timeout_rate=1.0, time_scale=0.01)
+        args_namespace.pairs, args_namespace.login_timeout = driver.pairs, 1
+        section = decode_section(agent_mssql_log_shipping.get_log_shipping_section(args_namespace, driver))
+        assert 'Adaptive Server connection timed out (sql0000)' in section['pairs'][0]['primary']['error']
+
+    def test_server_ages(self, fake_mssql, args_namespace):
+        args_namespace.server_ages = True
+        section = decode_section(agent_mssql_log_shipping.get_log_shipping_section(args_namespace, fake_mssql))
+        assert [len(connection.queries) for connection in fake_mssql.connections] == [2, 2]
+        assert 'server_current_time' not in section['primary'] and 'server_current_time' not in section['secondary']
+        assert section['primary']['status'][0]['last_backup_age'] == 840
+        assert section['primary']['status'][0]['last_backup_date_utc'] == '2024-02-26T13:30:01.340000'
+        assert (section['secondary']['status'][0]['last_copied_age'], section['secondary']['status'][0]['last_restored_age']) == (839, 839)
+
+        adjust = agent_mssql_log_shipping.QUERY['get_secondary_status_ages']['cache_adjust']
+        assert adjust([SECONDARY_STATUS_AGES_ROWS[0][:8] + (None, 839)], 60.4) == [SECONDARY_STATUS_AGES_ROWS[0][:8] + (None, 899)]
+
+    def test_profile(self, fake_mssql, args_namespace, monkeypatch, capsys, tmp_path):
+        profiler = agent_mssql_log_shipping.Profiler(str(tmp_path / 'profile.pstats'))
+        monkeypatch.setattr(agent_mssql_log_shipping, '_profiler', profiler)
+        profiler.start()
+        args_namespace.section_format = 2
+        expected = agent_mssql_log_shipping.get_log_shipping_section(args_namespace, fake_mssql)
+        profiler.stop(io.StringIO())
+        assert {'collect_hosts', 'map_many_results', 'columnar', 'zlib', 'base64'} <= set(profiler.phases)
+        assert all(entry['calls'] and entry['peak'] is not None for entry in profiler.phases.values())
+        assert set(profiler.hosts['localhost:1234']) == {'connect', 'get_primary_status', 'get_primary_jobs', 'get_server_current_time'}
+        assert os.path.exists(tmp_path / 'profile.pstats')
+
+        monkeypatch.setattr(agent_mssql_log_shipping, '_profiler', None)
+        write_section = agent_mssql_log_shipping.write_log_shipping_section
+        monkeypatch.setattr(agent_mssql_log_shipping, 'write_log_shipping_section', lambda args, stream: write_section(args, stream, fake_mssql))
+        agent_mssql_log_shipping.main(['-u', 'db_user', '-p', 'mypass123', '--section-format', '2', '--profile', 'localhost:1234', 'localhost:5678'])
+        output = capsys.readouterr()
+        assert decode_section(output.out)['primary'] == decode_section(expected)['primary']
+        assert output.err.startswith('Phase')
+        for phase in ('startup and imports (CPU time)', 'parse_arguments', 'collect_hosts', 'output', 'total after argument parsing', 'Host localhost:5678'):
+            assert phase in output.err
+        assert agent_mssql_log_shipping._profiler is None
+
+    def test_export(self, fake_mssql, args_namespace, tmp_path):
+        args_namespace.export = str(tmp_path / 'export' / 'log_shipping.prom')
+        args_namespace.pairs = [(('localhost', 1234), ('localhost', 5678)), (('localhost', 1234), ('failing', 5678))]
+        args_namespace.multi_pair = True
+        fake_mssql.failing_hosts = {'failing'}
+        agent_mssql_log_shipping.get_log_shipping_section(args_namespace, fake_mssql)
+        with open(args_namespace.export, encoding='utf-8') as export_file:
+            lines = export_file.read().splitlines()
+        assert lines[0] == '# TYPE mssql_log_shipping_gap_seconds gauge'
+        assert lines[-1] == '# EOF'
+        assert 'mssql_log_shipping_gap_seconds{pair="localhost:1234/localhost:5678",database="MYDB"} 0.05' in lines
+        assert 'mssql_log_shipping_host_up{host="failing:5678"} 0' in lines
+        assert 'mssql_log_shipping_host_up{host="localhost:1234"} 1' in lines
+        assert 'mssql_log_shipping_job_last_run_outcome{host="localhost:5678",job="LSRestore_NOCMSSQLREP03_MYDB",database="MYDB",role="restore"} 1' in lines
+        assert 'mssql_log_shipping_query_rows{host="localhost:1234",query="get_primary_status"} 1' in lines
+        assert len([line for line in lines if line.startswith('mssql_log_shipping_gap_seconds')]) == 1
+        assert os.listdir(tmp_path / 'export') == ['log_shipping.prom']
+
+        args_namespace.export_format, args_namespace.server_ages = 'json', True
+        agent_mssql_log_shipping.get_log_shipping_section(args_namespace, fake_mssql)
+        with open(args_namespace.export, encoding='utf-8') as export_file:
+            metrics = json.load(export_file)['metrics']
+        assert metrics['mssql_log_shipping_gap_seconds']['samples'] == [{'labels': {'pair': 'localhost:1234/localhost:5678', 'database': 'MYDB'}, 'value': 1.0}]
+        assert metrics['mssql_log_shipping_time_since_last_backup_seconds']['samples'][0]['value'] == 840.0
+        assert agent_mssql_log_shipping.openmetrics_label('a "b"\\\n') == 'a \\"b\\"\\\\\\n'
+
+    def test_delta(self, fake_mssql, args_namespace, monkeypatch, tmp_path):
+        args_namespace.delta = True
+        keyframe_dir = tmp_path / 'keyframes'
+        first = split_sections(agent_mssql_log_shipping.get_log_shipping_section(args_namespace, fake_mssql))['mssql_log_shipping']
+        assert first[0].split()[0] == 'k'
+        keyframe = decode_payload(first[1:])
+        second = split_sections(agent_mssql_log_shipping.get_log_shipping_section(args_namespace, fake_mssql))['mssql_log_shipping']
+        assert second[0].split()[0] == 'k' and second[0] != first[0]
+
+        keyframe_dir.mkdir()
+        (keyframe_dir / f"{first[0].split()[1]}.json").write_text('{}')
+        (keyframe_dir / f"{second[0].split()[1]}.json").write_text('{}')
+        monkeypatch.setitem(globals(), 'PRIMARY_STATUS_ROWS', [PRIMARY_STATUS_ROWS[0][:4] + (datetime.datetime(2024, 2, 26, 13, 45, 1, 340000),)])
+        third = split_sections(agent_mssql_log_shipping.get_log_shipping_section(args_namespace, fake_mssql))['mssql_log_shipping']
+        assert third[0].split()[:2] == ['d', second[0].split()[1]]
+        assert decode_payload(third[1:]) == {'d': {'primary': {'d': {'status': {'l': {'0': {'d': {'last_backup_date_utc': {'=': '2024-02-26T13:45:01.340000'}}}}}}}}}
+        assert agent_mssql_log_shipping.diff_data({'a': [1, 2], 'b': 1}, {'a': [1, 2, 3], 'c': None}) == {'d': {'a': {'=': [1, 2, 3]}, 'c': {'=': None}}, 'r': ['b']}
+
+        args_namespace.keyframe_interval = 0
+        fourth = split_sections(agent_mssql_log_shipping.get_log_shipping_section(args_namespace, fake_mssql))['mssql_log_shipping']
+        assert fourth[0].split()[0] == 'k'
+        assert decode_payload(fourth[1:])['secondary'] == keyframe['secondary']
+        assert sorted(os.listdir(keyframe_dir)) == [f"{second[0].split()[1]}.json"]
+
+    def test_multiple_addresses(self, fake_mssql, args_namespace, tmp_path):
+        args = agent_mssql_log_shipping.parse_arguments(['-u', 'db_user', '-p', 'mypass123', 'dead,slow,fast:1234', 'localhost:5678'])
+        assert args.primary == ('dead,slow,fast', 1234)
+        with pytest.raises(SystemExit):
+            agent_mssql_log_shipping.parse_arguments(['-u', 'db_user', '-p', 'mypass123', 'sql01,,sql02', 'localhost:5678'])
+
+        fake_mssql.failing_hosts = {'dead'}
+        fake_mssql.delays = {'slow': 0.3}
+        args_namespace.pairs = [(('dead,slow,fast', 1234), ('localhost', 5678))]
+        args_namespace.connect_stagger = 50
+        section = decode_section(agent_mssql_log_shipping.get_log_shipping_section(args_namespace, fake_mssql))
+        assert 'error' not in section['primary']
+        assert {connection.address for connection in fake_mssql.connections if connection.queries} == {('fast', 1234), ('localhost', 5678)}
+        addresses = agent_mssql_log_shipping.AddressCache(str(tmp_path))
+        assert addresses.load(('dead,slow,fast', 1234))['preferred'] == ('fast', 1234)
+        assert addresses.candidates(('dead,slow,fast', 1234), time.time()) == [('fast', 1234), ('dead', 1234), ('slow', 1234)]
+
+        fake_mssql.failing_hosts = {'dead', 'slow', 'fast'}
+        section = decode_section(agent_mssql_log_shipping.get_log_shipping_section(args_namespace, fake_mssql))
+        assert section['primary']['error'] == 'Unable to connect: fast'
+
+    def test_dns_cache(self, monkeypatch, tmp_path):
+        lookups = []
+
+        def getaddrinfo(host, port, type=0):
+            lookups.append(host)
+            if host == 'unknown':
+                raise OSError('Name or service not known')
+            return [(2, 1, 6, '', ('10.0.1.5', port)), (2, 1, 6, '', ('10.0.2.5', port)), (2, 1, 6, '', ('10.0.1.5', port))]
+        monkeypatch.setattr(agent_mssql_log_shipping.socket, 'getaddrinfo', getaddrinfo)
+        addresses = agent_mssql_log_shipping.AddressCache(str(tmp_path), ttl=300, resolve=True)
+        assert addresses.candidates(('listener,unknown', 1433), 1000) == [('10.0.1.5', 1433), ('10.0.2.5', 1433), ('unknown', 1433)]
+        addresses.remember(('listener,unknown', 1433), ('10.0.2.5', 1433))
+        assert addresses.candidates(('listener,unknown', 1433), 1299) == [('10.0.2.5', 1433), ('10.0.1.5', 1433), ('unknown', 1433)]
+        assert lookups == ['listener', 'unknown']
+        assert addresses.candidates(('listener,unknown', 1433), 1300)[0] == ('10.0.2.5', 1433)
+        assert lookups == ['listener', 'unknown'] * 2
+
+    def test_parse_cache_ttl(self):
+        args = agent_mssql_log_shipping.parse_arguments(['-u', 'db_user', '-p', 'mypass123', '--cache', '--cache-ttl', 'get_jobs=600', 'sql01', 'sql02'])
+        assert args.cache_ttls == {'get_jobs': 600}
+        with pytest.raises(SystemExit):
+            agent_mssql_log_shipping.parse_arguments(['-u', 'db_user', '-p', 'mypass123', '--cache-ttl', 'get_unknown=600', 'sql01', 'sql02'])
+
+
+class TestCollectorDaemon:
+    @pytest.fixture
+    def daemon_args(self, tmp_path):
+        return agent_mssql_log_shipping.parse_arguments([
+            '-u', 'db_user', '-p', 'mypass123', '--daemon', '--collector-socket', str(tmp_path / 'collector.sock'), '--state-dir', str(tmp_path),
+        ])
+
+    @pytest.fixture
+    def collector(self, daemon_args, fake_mssql):
+        pool = agent_mssql_log_shipping.ConnectionPool(fake_mssql, daemon_args.pool_size, daemon_args.health_interval)
+        server = agent_mssql_log_shipping.CollectorServer(daemon_args, pool)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        yield server
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+    def test_pool_reuses_connections(self, fake_mssql):
+        pool = agent_mssql_log_shipping.ConnectionPool(fake_mssql, size=1, health_interval=0)
+        with pool.connection('sql01', 'msdb', 'db_user', 'mypass123') as first:
+            pass
+        with pool.connection('sql01', 'msdb', 'db_user', 'mypass123') as second:
+            with pool.connection('sql01', 'msdb', 'db_user', 'mypass123') as third:
+                pass
+        assert first is second
+        assert third is not second
+        assert len(fake_mssql.connections) == 2
+        assert third.connected and not second.connected
+
+        fake_mssql.failing_hosts = {'sql01'}
+        pool.check_idle()
+        assert not third.connected
+        with pytest.raises(Exception):
+            with pool.connection('sql01', 'msdb', 'db_user', 'mypass123'):
+                pass
+
+    def test_pool_discards_connection_after_error(self, fake_mssql):
+        pool = agent_mssql_log_shipping.ConnectionPool(fake_mssql)
+        with pytest.raises(ValueError):
+            with pool.connection('sql01', 'msdb', 'db_user', 'mypass123') as first:
+                raise ValueError()
+        with pool.connection('sql01', 'msdb', 'db_user', 'mypass123') as second:
+            pass
+        assert first is not second
+        assert not first.connected
+
+    def test_client_uses_collector(self, collector, daemon_args, fake_mssql):
+        args = agent_mssql_log_shipping.parse_arguments([
+            '-u', 'db_user', '-p', 'mypass123', '--collector-socket', daemon_args.collector_socket, 'sql01', 'sql02',
+        ])
+        for _run in range(2):
+            section = decode_section(agent_mssql_log_shipping.get_section_from_collector(args))
+            assert section['primary']['status'][0]['primary_database'] == 'MYDB'
+        assert sorted(db.address for db in fake_mssql.connections) == [('sql01', 1433), ('sql02', 1433)]
+        assert set(collector.hosts) == {('sql01', 1433), ('sql02', 1433)}
+
+        fake_mssql.failing_hosts = {'sql03', 'sql04'}
+        args.pairs = [(('sql03', 1433), ('sql02', 1433))]
+        section = decode_section(agent_mssql_log_shipping.get_section_from_collector(args))
+        assert section['primary'] == {'error': 'Unable to connect: sql03'}
+        args.pairs = [(('sql03', 1433), ('sql04', 1433))]
+        with pytest.raises(Exception, match='Unable to connect: sql03'):
+            agent_mssql_log_shipping.get_section_from_collector(args)
+
+    def test_client_fallback(self, tmp_path):
+        args = agent_mssql_log_shipping.parse_arguments([
+            '-u', 'db_user', '-p', 'mypass123', '--collector-socket', str(tmp_path / 'missing.sock'), 'sql01', 'sql02',
+        ])
+        assert agent_mssql_log_shipping.get_section_from_collector(args) is None
+        assert not os.path.exists(args.collector_socket)
+
+    def test_client_fallback_on_hanging_daemon(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(agent_mssql_log_shipping, 'COLLECTOR_TIMEOUT_GRACE', 0)
+        args = agent_mssql_log_shipping.parse_arguments([
+            '-u', 'db_user', '-p', 'mypass123', '--login-timeout', '1', '--collector-socket', str(tmp_path / 'hanging.sock'), 'sql01', 'sql02',
+        ])
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+            server.bind(args.collector_socket)
+            server.listen()
+            start = time.time()
+            assert agent_mssql_log_shipping.get_section_from_collector(args) is None
+            assert time.time() - start < 2
+
+    def test_collector_request_options(self, collector, daemon_args, fake_mssql, monkeypatch):
+        requests = []
+        get_section = agent_mssql_log_shipping.get_log_shipping_section
+        monkeypatch.setattr(agent_mssql_log_shipping, 'get_log_shipping_section', lambda args, *options: requests.append(args) or get_section(args, *options))
+        args = agent_mssql_log_shipping.parse_arguments([
+            '-u', 'db_user', '-p', 'mypass123', '--collector-socket', daemon_args.collector_socket,
+            '--timeout', '7', '--login-timeout', '9', '--pair-timeout', '11', '--workers', '3', 'sql01', 'sql02',
+        ])
+        agent_mssql_log_shipping.get_section_from_collector(args)
+        assert (requests[0].timeout, requests[0].login_timeout, requests[0].pair_timeout, requests[0].workers) == (7, 9, 11, 3)
+
+    def test_daemon_warmup(self, tmp_path, fake_mssql, monkeypatch):
+        args = agent_mssql_log_shipping.parse_arguments([
+            '-u', 'db_user', '-p', 'mypass123', '--daemon', '--collector-socket', str(tmp_path / 'collector.sock'), '--state-dir', str(tmp_path),
+            'sql01a,sql01b', 'sql02',
+        ])
+        fake_mssql.failing_hosts = {'sql01a'}
+
+        def serve_forever(server):
+            assert [db.address for db in fake_mssql.connections] == [('sql01b', 1433), ('sql02', 1433)]
+            raise KeyboardInterrupt()
+        monkeypatch.setattr(agent_mssql_log_shipping.CollectorServer, 'serve_forever', serve_forever)
+        agent_mssql_log_shipping.run_collector_daemon(args, fake_mssql)
+        assert len(fake_mssql.connections) == 2
+
+    def test_refresh_cache(self, daemon_args, fake_mssql):
+        daemon_args.cache = True
+        pool = agent_mssql_log_shipping.ConnectionPool(fake_mssql)
+        cache = agent_mssql_log_shipping.QueryCache(daemon_args.state_dir)
+        roles = [agent_mssql_log_shipping.DbType.PRIMARY]
+        agent_mssql_log_shipping.refresh_cache(daemon_args, ('sql01', 1433), roles, pool.connection, cache)
+        assert set(cache.load(('sql01', 1433))) == {'get_primary_jobs', 'get_server_current_time'}
+        agent_mssql_log_shipping.refresh_cache(daemon_args, ('sql01', 1433), roles, pool.connection, cache)
+        assert len(fake_mssql.connections[0].queries) == 2
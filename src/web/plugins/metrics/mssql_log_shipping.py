@@ -12,6 +12,18 @@ metric_info['mssql_log_shipping_gap'] = {
     'color': '34/a',
 }
 
+metric_info['mssql_log_shipping_gap_p95'] = {
+    'title': _('Replication Gap 95th Percentile'),
+    'unit': 's',
+    'color': '36/a',
+}
+
+metric_info['mssql_log_shipping_gap_time_to_crit'] = {
+    'title': _('Replication Gap Projected Time To CRIT'),
+    'unit': 's',
+    'color': '32/a',
+}
+
 metric_info['mssql_log_shipping_time_since_last_restore'] = {
     'title': _('Time Since Last Restore'),
     'unit': 's',
@@ -23,3 +35,159 @@ metric_info['mssql_log_shipping_time_since_last_backup'] = {
     'unit': 's',
     'color': '16/a',
 }
+
+metric_info['mssql_log_shipping_pending_backups'] = {
+    'title': _('Pending Log Backups'),
+    'unit': 'count',
+    'color': '42/a',
+}
+
+metric_info['mssql_log_shipping_pending_bytes'] = {
+    'title': _('Pending Log Backup Size'),
+    'unit': 'bytes',
+    'color': '44/a',
+}
+
+metric_info['mssql_log_shipping_restore_rate'] = {
+    'title': _('Restore Throughput'),
+    'unit': 'bytes/s',
+    'color': '46/a',
+}
+
+metric_info['mssql_log_shipping_catch_up_time'] = {
+    'title': _('Estimated Catch-up Time'),
+    'unit': 's',
+    'color': '26/a',
+}
+
+metric_info['mssql_log_shipping_copy_failures'] = {
+    'title': _('Failed Copies'),
+    'unit': 'count',
+    'color': '12/a',
+}
+
+metric_info['mssql_log_shipping_restore_failures'] = {
+    'title': _('Failed Restores'),
+    'unit': 'count',
+    'color': '15/a',
+}
+
+metric_info['mssql_log_shipping_agent_run_time'] = {
+    'title': _('Agent Run Time'),
+    'unit': 's',
+    'color': '11/a',
+}
+
+metric_info['mssql_log_shipping_agent_raw_bytes'] = {
+    'title': _('Raw Payload Size'),
+    'unit': 'bytes',
+    'color': '21/a',
+}
+
+metric_info['mssql_log_shipping_agent_compressed_bytes'] = {
+    'title': _('Compressed Payload Size'),
+    'unit': 'bytes',
+    'color': '23/a',
+}
+
+metric_info['mssql_log_shipping_agent_encoded_bytes'] = {
+    'title': _('Encoded Payload Size'),
+    'unit': 'bytes',
+    'color': '25/a',
+}
+
+metric_info['mssql_log_shipping_agent_connect_time'] = {
+    'title': _('Connect Time'),
+    'unit': 's',
+    'color': '31/a',
+}
+
+metric_info['mssql_log_shipping_agent_query_time'] = {
+    'title': _('Query Time'),
+    'unit': 's',
+    'color': '33/a',
+}
+
+metric_info['mssql_log_shipping_agent_rows'] = {
+    'title': _('Rows'),
+    'unit': 'count',
+    'color': '35/a',
+}
+
+metric_info['mssql_log_shipping_summary_ok_databases'] = {
+    'title': _('OK Databases'),
+    'unit': 'count',
+    'color': '13/a',
+}
+
+metric_info['mssql_log_shipping_summary_warn_databases'] = {
+    'title': _('WARN Databases'),
+    'unit': 'count',
+    'color': '23/a',
+}
+
+metric_info['mssql_log_shipping_summary_crit_databases'] = {
+    'title': _('CRIT Databases'),
+    'unit': 'count',
+    'color': '11/a',
+}
+
+metric_info['mssql_log_shipping_summary_failed_pairs'] = {
+    'title': _('Failed Pairs'),
+    'unit': 'count',
+    'color': '26/a',
+}
+
+metric_info['mssql_log_shipping_summary_gap_max'] = {
+    'title': _('Worst Replication Gap'),
+    'unit': 's',
+    'color': '34/b',
+}
+
+metric_info['mssql_log_shipping_summary_gap_p50'] = {
+    'title': _('Replication Gap 50th Percentile'),
+    'unit': 's',
+    'color': '32/b',
+}
+
+metric_info['mssql_log_shipping_summary_gap_p95'] = {
+    'title': _('Replication Gap 95th Percentile'),
+    'unit': 's',
+    'color': '36/b',
+}
+
+metric_info['mssql_log_shipping_summary_time_since_last_restore_p50'] = {
+    'title': _('Time Since Last Restore 50th Percentile'),
+    'unit': 's',
+    'color': '12/b',
+}
+
+metric_info['mssql_log_shipping_summary_time_since_last_restore_p95'] = {
+    'title': _('Time Since Last Restore 95th Percentile'),
+    'unit': 's',
+    'color': '14/b',
+}
+
+metric_info['mssql_log_shipping_summary_time_since_last_restore_max'] = {
+    'title': _('Maximum Time Since Last Restore'),
+    'unit': 's',
+    'color': '16/b',
+}
+
+metric_info['mssql_log_shipping_summary_time_since_last_backup_p50'] = {
+    'title': _('Time Since Last Backup 50th Percentile'),
+    'unit': 's',
+    'color': '42/b',
+}
+
+metric_info['mssql_log_shipping_summary_time_since_last_backup_p95'] = {
+    'title': _('Time Since Last Backup 95th Percentile'),
+    'unit': 's',
+    'color': '44/b',
+}
+
+metric_info['mssql_log_shipping_summary_time_since_last_backup_max'] = {
+    'title': _('Maximum Time Since Last Backup'),
+    'unit': 's',
+    'color': '46/b',
+}
@@ -5,10 +5,14 @@
 """Checkmk special agent for MSSQL Log Shipping"""
 from cmk.gui.plugins.wato.utils import IndividualOrStoredPassword
 from cmk.gui.valuespec import (
+    Checkbox,
     Dictionary,
+    DropdownChoice,
     Integer,
     TextAscii,
     HostAddress,
+    ListOf,
+    Transform,
     Tuple
 )
 
@@ -21,6 +25,34 @@ from cmk.gui.i18n import _
 from cmk.gui.plugins.wato.datasource_programs import RulespecGroupVMCloudContainer
 
 
+def _address_valuespec(title, help):
+    return Transform(
+        Tuple(
+            title=title,
+            help=help,
+            elements=[
+                HostAddress(
+                    title=_('Address'),
+                    allow_empty=False
+                ),
+                Integer(
+                    title=_("TCP Port"),
+                    default_value=1433,
+                ),
+                ListOf(
+                    HostAddress(
+                        allow_empty=False
+                    ),
+                    title=_("Additional Addresses"),
+                    help=_('Further addresses of the same instance, e.g. the IP addresses of an availability group listener in other subnets. The agent tries all addresses concurrently, starting with the one that connected last, and uses the first successful connection.'),
+                    add_label=_("Add address"),
+                ),
+            ],
+        ),
+        forth=lambda address: address if len(address) == 3 else (address[0], address[1], []),
+    )
+
+
 def _valuespec_special_agents_mssql_log_shipping():
     return Dictionary(
         title=_('Agent MSSQL Log Shipping'),
@@ -58,37 +90,255 @@ def _valuespec_special_agents_mssql_log_shipping():
                 ),
             ),
             (
-                "primary",
-                Tuple(
-                    title=_("Primary Database"),
-                    help=_('Hostname or IP-Address and port(Optional) where the primary databases lives'),
-                    elements=[
-                        HostAddress(
-                            title=_('Address'),
-                            allow_empty=False
-                        ),
-                        Integer(
-                            title=_("TCP Port"),
-                            default_value=1433,
-                        ),
+                "workers",
+                Integer(
+                    title=_("Workers"),
+                    help=_('Maximum number of hosts queried concurrently, default 8'),
+                    minvalue=1,
+                ),
+            ),
+            (
+                "pair-timeout",
+                Integer(
+                    title=_("Pair Timeout"),
+                    help=_('Deadline in seconds for the login and all queries of each host of a pair, default 0 (no deadline). The query timeout is shortened to the time left before every query.'),
+                ),
+            ),
+            (
+                "run-timeout",
+                Integer(
+                    title=_("Run Timeout"),
+                    help=_('Overall wall-clock budget in seconds for collecting all hosts, default 0 (no budget). Hosts not completed in time are reported as unreachable while the data of the other hosts is still shown.'),
+                ),
+            ),
+            (
+                "section-format",
+                DropdownChoice(
+                    title=_("Section Format"),
+                    help=_('Encoding of the agent section. The columnar format sends column names once per table, timestamps as integers and repeated strings once, which gives smaller sections that are cheaper to parse.'),
+                    choices=[
+                        (2, _("Columnar (v2)")),
+                        (1, _("JSON rows (v1)")),
                     ],
+                    default_value=2,
                 ),
             ),
             (
-                "secondary",
-                Tuple(
-                    title=_("Secondary Database"),
-                    help=_('Hostname or IP-Address and port(Optional) where the secondary databases lives'),
-                    elements=[
-                        HostAddress(
-                            title=_('Address'),
-                            allow_empty=False
-                        ),
-                        Integer(
-                            title=_("TCP Port"),
-                            default_value=1433,
-                        ),
+                "batch",
+                Checkbox(
+                    title=_("Batch Queries"),
+                    label=_("Send all queries of a host in a single round trip"),
+                    help=_('Sends the status, jobs and server time queries of each host as one batch instead of one round trip per query. Recommended for high latency links.'),
+                ),
+            ),
+            (
+                "all-jobs",
+                Checkbox(
+                    title=_("All Agent Jobs"),
+                    label=_("Collect every SQL Server Agent job"),
+                    help=_('By default only the backup, copy and restore jobs referenced by log shipping are collected, tagged with their database and role. Enable this to collect all jobs of msdb.dbo.sysjobs instead.'),
+                ),
+            ),
+            (
+                "cache",
+                Checkbox(
+                    title=_("Query Cache"),
+                    label=_("Reuse rarely changing query results"),
+                    help=_('Caches the job and server time query results on disk and reuses them until their TTL expires (jobs 5 minutes, server time 1 hour). The status queries are always executed. When cached data is used the section is marked as cached with the age of the oldest entry.'),
+                ),
+            ),
+            (
+                "history",
+                Checkbox(
+                    title=_("History Events"),
+                    label=_("Read copy and restore events since the previous run"),
+                    help=_('Reads the new rows of log_shipping_monitor_history_detail and log_shipping_monitor_error_detail on the secondaries, so failed copies and restores between two checks are reported even when the latest state is fine again. The position of the last row read is kept per host in the state directory of the agent.'),
+                ),
+            ),
+            (
+                "lsn-lag",
+                Checkbox(
+                    title=_("LSN Lag"),
+                    label=_("Measure the lag in log backups and bytes"),
+                    help=_('Reads the new log backups of msdb.dbo.backupset on the primaries and of msdb.dbo.restorehistory on the secondaries since the previous run. The check then reports the log backups and bytes waiting to be restored, the restore throughput and the estimated time to catch up. The recent rows are kept per host in the state directory of the agent.'),
+                ),
+            ),
+            (
+                "topology",
+                Checkbox(
+                    title=_("Topology"),
+                    label=_("Pair the databases by the log shipping configuration"),
+                    help=_('Reads which primary database ships to which secondary database from log_shipping_primary_secondaries and log_shipping_monitor_secondary instead of pairing databases with the same name, so renamed secondary databases and primaries with several secondaries are monitored correctly. The configuration is cached for one hour in the state directory of the agent. Services are named after the secondary database.'),
+                ),
+            ),
+            (
+                "server-ages",
+                Checkbox(
+                    title=_("Server-Side Ages"),
+                    label=_("Compute the backup and restore ages on the instances"),
+                    help=_('Every instance computes the seconds since the last backup, copy and restore against its own clock in the status query, and the separate server time query is skipped. The check then compares these ages directly, so it no longer depends on the clocks of the instances and of the monitoring server being synchronized. The timestamps are still reported.'),
+                ),
+            ),
+            (
+                "dns-cache",
+                Checkbox(
+                    title=_("DNS Cache"),
+                    label=_("Connect to all IP addresses of the instances"),
+                    help=_('Resolves the addresses of the instances to all of their IP addresses, e.g. the addresses of a multi-subnet availability group listener, and tries them concurrently. The resolved addresses are kept in the state directory of the agent for the DNS Cache TTL, so a DNS server that is down does not delay the agent.'),
+                ),
+            ),
+            (
+                "dns-ttl",
+                Integer(
+                    title=_("DNS Cache TTL"),
+                    help=_('Seconds the resolved addresses are reused, default 300'),
+                    unit=_("seconds"),
+                    minvalue=0,
+                ),
+            ),
+            (
+                "connect-stagger",
+                Integer(
+                    title=_("Connection Attempt Delay"),
+                    help=_('Milliseconds to wait for the connection to one address of an instance before also trying its next address, default 500'),
+                    unit=_("ms"),
+                    minvalue=0,
+                ),
+            ),
+            (
+                "circuit-breaker",
+                Checkbox(
+                    title=_("Circuit Breaker"),
+                    label=_("Skip instances that failed repeatedly"),
+                    help=_('After a number of consecutive connection failures an instance is no longer contacted until its next probe, and its last known good status and topology data is reported with its age instead. Copy and restore events of the option History are not repeated. The time until the probe doubles on every failed probe, up to one hour. This keeps instances down for maintenance from blocking the agent for the whole login timeout on every run. The state is kept per host in the state directory of the agent.'),
+                ),
+            ),
+            (
+                "circuit-failures",
+                Integer(
+                    title=_("Circuit Breaker Failures"),
+                    help=_('Consecutive failures after which an instance is skipped, default 3'),
+                    minvalue=1,
+                ),
+            ),
+            (
+                "circuit-backoff",
+                Integer(
+                    title=_("Circuit Breaker Backoff"),
+                    help=_('Seconds until the first probe of a skipped instance, default 60'),
+                    unit=_("seconds"),
+                    minvalue=1,
+                ),
+            ),
+            (
+                "collector-socket",
+                TextAscii(
+                    title=_("Collector Daemon Socket"),
+                    allow_empty=False,
+                    help=_('Unix socket of a running collector daemon (agent_mssql_log_shipping --daemon) that keeps pooled connections to the databases. The section is fetched from the daemon with the timeouts and workers of this rule, falling back to querying the databases directly when it is not running or does not answer within the run timeout, or the login timeout without run timeout, plus 5 seconds.'),
+                ),
+            ),
+            (
+                "piggyback",
+                DropdownChoice(
+                    title=_("Piggyback Output"),
+                    help=_('Sends the log shipping data as piggyback data to the SQL Server hosts instead of the host of this rule, so the services are created on the database hosts. Each host receives the pairs it takes part in with the selected role.'),
+                    choices=[
+                        ("secondary", _("Secondary hosts")),
+                        ("primary", _("Primary hosts")),
+                        ("both", _("Primary and secondary hosts")),
                     ],
+                    default_value="secondary",
+                ),
+            ),
+            (
+                "piggyback-hosts",
+                ListOf(
+                    Tuple(
+                        elements=[
+                            _address_valuespec(
+                                _("Database Address"),
+                                _('Address and port as configured for the primary or secondary database'),
+                            ),
+                            TextAscii(
+                                title=_("Checkmk Host Name"),
+                                allow_empty=False,
+                            ),
+                        ],
+                    ),
+                    title=_("Piggyback Host Names"),
+                    help=_('Checkmk host names for database addresses. By default the piggyback data is sent to a host named like the address.'),
+                    add_label=_("Add host name"),
+                ),
+            ),
+            (
+                "delta",
+                Checkbox(
+                    title=_("Delta Output"),
+                    label=_("Send only the changes since the last keyframe"),
+                    help=_('The agent keeps the last full section it sent as keyframe in its state directory and then only sends the changed values, which reduces the agent output for many pairs considerably. The check plugin stores the keyframes it received in the temporary directory of the site. A full keyframe is sent again after the keyframe interval, when the changes get large, or when the check plugin has not stored the previous keyframe, so a lost keyframe never leaves the checks without data for more than one run.'),
+                ),
+            ),
+            (
+                "keyframe-interval",
+                Integer(
+                    title=_("Keyframe Interval"),
+                    help=_('Seconds after which the delta output sends a full keyframe again, default 3600'),
+                    unit=_("seconds"),
+                    minvalue=0,
+                ),
+            ),
+            (
+                "export",
+                TextAscii(
+                    title=_("Metrics Export File"),
+                    allow_empty=False,
+                    help=_('Also writes the gap, the time since the last backup and restore, the job outcomes and the collection timings of every run to this file on the Checkmk server, so other monitoring systems can read them without querying the instances again. The file is replaced atomically. With a collector daemon the daemon writes the file.'),
+                ),
+            ),
+            (
+                "export-format",
+                DropdownChoice(
+                    title=_("Metrics Export Format"),
+                    choices=[
+                        ("openmetrics", _("OpenMetrics text")),
+                        ("json", _("JSON")),
+                    ],
+                    default_value="openmetrics",
+                ),
+            ),
+            (
+                "primary",
+                _address_valuespec(
+                    _("Primary Database"),
+                    _('Hostname or IP-Address and port(Optional) where the primary databases lives'),
+                ),
+            ),
+            (
+                "secondary",
+                _address_valuespec(
+                    _("Secondary Database"),
+                    _('Hostname or IP-Address and port(Optional) where the secondary databases lives'),
+                ),
+            ),
+            (
+                "additional_pairs",
+                ListOf(
+                    Tuple(
+                        elements=[
+                            _address_valuespec(
+                                _("Primary Database"),
+                                _('Hostname or IP-Address and port(Optional) where the primary databases lives'),
+                            ),
+                            _address_valuespec(
+                                _("Secondary Database"),
+                                _('Hostname or IP-Address and port(Optional) where the secondary databases lives'),
+                            ),
+                        ],
+                    ),
+                    title=_("Additional Pairs"),
+                    help=_('Further primary and secondary pairs collected in the same agent run. Hosts shared between pairs are queried only once. The services of every pair are prefixed with the pair name.'),
+                    add_label=_("Add pair"),
                 ),
             ),
         ]
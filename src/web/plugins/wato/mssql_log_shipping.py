@@ -5,14 +5,20 @@
 from cmk.gui.i18n import _
 
 from cmk.gui.valuespec import (
+    Age,
+    Checkbox,
     Dictionary,
+    Filesize,
+    Float,
     Integer,
+    MonitoringState,
     TextInput,
     Tuple
 )
 
 from cmk.gui.plugins.wato import (
     CheckParameterRulespecWithItem,
+    CheckParameterRulespecWithoutItem,
     rulespec_registry,
     RulespecGroupEnforcedServicesApplications,
 )
@@ -45,6 +51,75 @@ def _parameter_valuespec_mssql_log_shipping():
                     help = _('Represents the time in seconds between the last backup log in the primary database and the last restore in the secondary database.')
                 )
             ),
+            (
+                "gap_ignore_shrinking",
+                Checkbox(
+                    title = _("Gap Trend"),
+                    label = _("Do not warn on the gap while it is shrinking"),
+                    help = _('A gap above the warning level is reported as OK while its growth rate over the trend window is negative. The critical level always applies.')
+                )
+            ),
+            (
+                "trend_window",
+                Age(
+                    title = _("Gap Trend Window"),
+                    default_value = 3600,
+                    help = _('Time range of the gap samples used for the growth rate, the projected time to CRIT and the 95th percentile. At most %d samples are kept per service, spread over this window.') % 64
+                )
+            ),
+            (
+                "gap_growth_upper",
+                Tuple(
+                    title = _("Gap Growth Rate"),
+                    elements = [
+                        Integer(
+                            title=_("Warning"),
+                            unit=_("seconds per hour"),
+                            default_value = 600
+                        ),
+                        Integer(
+                            title=_("Critical"),
+                            unit=_("seconds per hour"),
+                            default_value = 1200
+                        ),
+                    ],
+                    help = _('Increase of the gap per hour, from a linear regression over the trend window.')
+                )
+            ),
+            (
+                "gap_time_to_crit_lower",
+                Tuple(
+                    title = _("Gap Projected Time To CRIT"),
+                    elements = [
+                        Age(
+                            title=_("Warning below"),
+                            default_value = 3600
+                        ),
+                        Age(
+                            title=_("Critical below"),
+                            default_value = 900
+                        ),
+                    ],
+                    help = _('Time until the gap reaches its critical level at the current growth rate. Only reported while the gap is growing.')
+                )
+            ),
+            (
+                "gap_p95_upper",
+                Tuple(
+                    title = _("Gap 95th Percentile"),
+                    elements = [
+                        Integer(
+                            title=_("Warning"),
+                            default_value = 900
+                        ),
+                        Integer(
+                            title=_("Critical"),
+                            default_value = 1800
+                        ),
+                    ],
+                    help = _('95th percentile in seconds of the gap samples in the trend window.')
+                )
+            ),
             (
                 "time_since_last_restore_upper",
                 Tuple(
@@ -62,6 +137,14 @@ def _parameter_valuespec_mssql_log_shipping():
                     help = _('Represents the time in seconds since the last restore in the secondary database.')
                 )
             ),
+            (
+                "use_restore_threshold",
+                Checkbox(
+                    title = _("Restore Threshold"),
+                    label = _("Use the restore threshold of the log shipping monitor"),
+                    help = _('With the option Topology of the special agent, the restore alert threshold configured for the secondary database in log_shipping_monitor_secondary is used as critical level of the time since the last restore, when its alert is enabled.')
+                )
+            ),
             (
                 "time_since_last_backup_upper",
                 Tuple(
@@ -79,6 +162,101 @@ def _parameter_valuespec_mssql_log_shipping():
                     help = _('Represents the time in seconds since the last Log backup in the primary database.')
                 )
             ),
+            (
+                "pending_backups_upper",
+                Tuple(
+                    title = _("Pending Log Backups"),
+                    elements = [
+                        Integer(
+                            title=_("Warning"),
+                            default_value = 4
+                        ),
+                        Integer(
+                            title=_("Critical"),
+                            default_value = 8
+                        ),
+                    ],
+                    help = _('Number of log backups of the primary not yet restored on the secondary. Requires the option LSN Lag of the special agent.')
+                )
+            ),
+            (
+                "pending_bytes_upper",
+                Tuple(
+                    title = _("Pending Bytes"),
+                    elements = [
+                        Filesize(
+                            title=_("Warning"),
+                            default_value = 1024 ** 3
+                        ),
+                        Filesize(
+                            title=_("Critical"),
+                            default_value = 4 * 1024 ** 3
+                        ),
+                    ],
+                    help = _('Size of the log backups of the primary not yet restored on the secondary. Requires the option LSN Lag of the special agent.')
+                )
+            ),
+            (
+                "catch_up_time_upper",
+                Tuple(
+                    title = _("Estimated Catch-up Time"),
+                    elements = [
+                        Integer(
+                            title=_("Warning"),
+                            unit=_("seconds"),
+                            default_value = 1800
+                        ),
+                        Integer(
+                            title=_("Critical"),
+                            unit=_("seconds"),
+                            default_value = 3600
+                        ),
+                    ],
+                    help = _('Pending bytes divided by the restore throughput of the last hour. Requires the option LSN Lag of the special agent.')
+                )
+            ),
+            (
+                "copy_failures_upper",
+                Tuple(
+                    title = _("Failed Copies"),
+                    elements = [
+                        Integer(
+                            title=_("Warning"),
+                            default_value = 1
+                        ),
+                        Integer(
+                            title=_("Critical"),
+                            default_value = 3
+                        ),
+                    ],
+                    help = _('Number of failed copy jobs since the previous agent run, read from the log shipping monitor history when the option History Events of the special agent is enabled.')
+                )
+            ),
+            (
+                "restore_failures_upper",
+                Tuple(
+                    title = _("Failed Restores"),
+                    elements = [
+                        Integer(
+                            title=_("Warning"),
+                            default_value = 1
+                        ),
+                        Integer(
+                            title=_("Critical"),
+                            default_value = 3
+                        ),
+                    ],
+                    help = _('Number of failed restore jobs since the previous agent run, read from the log shipping monitor history when the option History Events of the special agent is enabled.')
+                )
+            ),
+            (
+                "circuit_open_state",
+                MonitoringState(
+                    title = _("State On Circuit Open"),
+                    default_value = 1,
+                    help = _('State while the primary or secondary instance is skipped by the circuit breaker of the special agent and the last known good data is shown instead.')
+                )
+            ),
         ],
     )
 
@@ -93,3 +271,281 @@ rulespec_registry.register(
         title=lambda: _("MSSQL Log Shipping"),
     )
 )
+
+
+def _seconds_levels(title, help, warn, crit):
+    return Tuple(
+        title = title,
+        elements = [
+            Float(
+                title=_("Warning"),
+                unit=_("seconds"),
+                default_value = warn
+            ),
+            Float(
+                title=_("Critical"),
+                unit=_("seconds"),
+                default_value = crit
+            ),
+        ],
+        help = help
+    )
+
+
+def _parameter_valuespec_mssql_log_shipping_agent():
+    return Dictionary(
+        elements=[
+            (
+                "run_time_upper",
+                _seconds_levels(
+                    _("Run Time"),
+                    _('Total run time of the special agent. Alert before it reaches the timeout of the datasource program.'),
+                    30.0,
+                    50.0,
+                )
+            ),
+        ],
+    )
+
+
+rulespec_registry.register(
+    CheckParameterRulespecWithoutItem(
+        check_group_name="mssql_log_shipping_agent",
+        group=RulespecGroupEnforcedServicesApplications,
+        match_type="dict",
+        parameter_valuespec=_parameter_valuespec_mssql_log_shipping_agent,
+        title=lambda: _("MSSQL Log Shipping Agent"),
+    )
+)
+
+
+def _item_valuespec_mssql_log_shipping_agent_host():
+    return TextInput(
+        title="Host address",
+        help="Insert the address of the SQL Server instance here, with the port if it is not 1433"
+    )
+
+
+def _parameter_valuespec_mssql_log_shipping_agent_host():
+    return Dictionary(
+        elements=[
+            (
+                "connect_time_upper",
+                _seconds_levels(
+                    _("Connect Time"),
+                    _('Time needed to connect and log in to the instance.'),
+                    5.0,
+                    15.0,
+                )
+            ),
+            (
+                "query_time_upper",
+                _seconds_levels(
+                    _("Query Time"),
+                    _('Time needed to execute all queries on the instance.'),
+                    5.0,
+                    15.0,
+                )
+            ),
+            (
+                "circuit_open_state",
+                MonitoringState(
+                    title = _("State On Circuit Open"),
+                    default_value = 2,
+                    help = _('State while the instance is skipped by the circuit breaker of the special agent after repeated connection failures.')
+                )
+            ),
+        ],
+    )
+
+
+rulespec_registry.register(
+    CheckParameterRulespecWithItem(
+        check_group_name="mssql_log_shipping_agent_host",
+        group=RulespecGroupEnforcedServicesApplications,
+        match_type="dict",
+        item_spec=_item_valuespec_mssql_log_shipping_agent_host,
+        parameter_valuespec=_parameter_valuespec_mssql_log_shipping_agent_host,
+        title=lambda: _("MSSQL Log Shipping Agent Host"),
+    )
+)
+
+
+def _count_levels(title, help, warn, crit):
+    return Tuple(
+        title = title,
+        elements = [
+            Integer(
+                title=_("Warning at"),
+                unit=_("databases"),
+                default_value = warn
+            ),
+            Integer(
+                title=_("Critical at"),
+                unit=_("databases"),
+                default_value = crit
+            ),
+        ],
+        help = help
+    )
+
+
+def _parameter_valuespec_mssql_log_shipping_summary():
+    return Dictionary(
+        elements=[
+            (
+                "gap_upper",
+                _seconds_levels(
+                    _("Gap Of A Database"),
+                    _('Levels on the gap used to classify each database as OK, WARN or CRIT.'),
+                    900.0,
+                    1800.0,
+                )
+            ),
+            (
+                "time_since_last_restore_upper",
+                _seconds_levels(
+                    _("Time Since Last Restore Of A Database"),
+                    _('Levels on the time since the last restore used to classify each database as OK, WARN or CRIT.'),
+                    3600.0,
+                    7200.0,
+                )
+            ),
+            (
+                "use_restore_threshold",
+                Checkbox(
+                    title = _("Restore Threshold"),
+                    label = _("Use the restore threshold of the log shipping monitor"),
+                    help = _('With the option Topology of the special agent, the restore alert threshold of each secondary database is used instead of the levels above, when its alert is enabled.')
+                )
+            ),
+            (
+                "time_since_last_backup_upper",
+                _seconds_levels(
+                    _("Time Since Last Backup Of A Database"),
+                    _('Levels on the time since the last log backup used to classify each database as OK, WARN or CRIT.'),
+                    3600.0,
+                    7200.0,
+                )
+            ),
+            (
+                "warn_databases_upper",
+                _count_levels(
+                    _("WARN Databases"),
+                    _('Levels on the number of databases classified as WARN.'),
+                    1,
+                    10,
+                )
+            ),
+            (
+                "crit_databases_upper",
+                _count_levels(
+                    _("CRIT Databases"),
+                    _('Levels on the number of databases classified as CRIT. By default the summary goes CRIT with the first CRIT database.'),
+                    1,
+                    1,
+                )
+            ),
+            (
+                "failed_pairs_upper",
+                _count_levels(
+                    _("Failed Pairs"),
+                    _('Levels on the number of pairs whose primary or secondary instance could not be queried. Their databases are not counted above. By default the summary goes CRIT with the first failed pair.'),
+                    1,
+                    1,
+                )
+            ),
+            (
+                "gap_max_upper",
+                _seconds_levels(
+                    _("Worst Gap"),
+                    _('Levels on the largest gap of all databases.'),
+                    900.0,
+                    1800.0,
+                )
+            ),
+            (
+                "gap_p50_upper",
+                _seconds_levels(
+                    _("Gap 50th Percentile"),
+                    _('Levels on the median gap of all databases.'),
+                    600.0,
+                    900.0,
+                )
+            ),
+            (
+                "gap_p95_upper",
+                _seconds_levels(
+                    _("Gap 95th Percentile"),
+                    _('Levels on the 95th percentile of the gap of all databases.'),
+                    900.0,
+                    1800.0,
+                )
+            ),
+            (
+                "time_since_last_restore_p50_upper",
+                _seconds_levels(
+                    _("Time Since Last Restore 50th Percentile"),
+                    _('Levels on the median of the time since the last restore of all databases.'),
+                    3600.0,
+                    7200.0,
+                )
+            ),
+            (
+                "time_since_last_restore_p95_upper",
+                _seconds_levels(
+                    _("Time Since Last Restore 95th Percentile"),
+                    _('Levels on the 95th percentile of the time since the last restore of all databases.'),
+                    3600.0,
+                    7200.0,
+                )
+            ),
+            (
+                "time_since_last_restore_max_upper",
+                _seconds_levels(
+                    _("Maximum Time Since Last Restore"),
+                    _('Levels on the longest time since the last restore of all databases.'),
+                    3600.0,
+                    7200.0,
+                )
+            ),
+            (
+                "time_since_last_backup_p50_upper",
+                _seconds_levels(
+                    _("Time Since Last Backup 50th Percentile"),
+                    _('Levels on the median of the time since the last log backup of all databases.'),
+                    3600.0,
+                    7200.0,
+                )
+            ),
+            (
+                "time_since_last_backup_p95_upper",
+                _seconds_levels(
+                    _("Time Since Last Backup 95th Percentile"),
+                    _('Levels on the 95th percentile of the time since the last log backup of all databases.'),
+                    3600.0,
+                    7200.0,
+                )
+            ),
+            (
+                "time_since_last_backup_max_upper",
+                _seconds_levels(
+                    _("Maximum Time Since Last Backup"),
+                    _('Levels on the longest time since the last log backup of all databases.'),
+                    3600.0,
+                    7200.0,
+                )
+            ),
+        ],
+    )
+
+
+rulespec_registry.register(
+    CheckParameterRulespecWithoutItem(
+        check_group_name="mssql_log_shipping_summary",
+        group=RulespecGroupEnforcedServicesApplications,
+        match_type="dict",
+        parameter_valuespec=_parameter_valuespec_mssql_log_shipping_summary,
+        title=lambda: _("MSSQL Log Shipping Summary"),
+    )
+)